@@ -0,0 +1,443 @@
+"""Benchmarks for the parser engine
+
+Cold vs warm start: every run is a fresh interpreter, the cold runs start from an empty cache directory and
+the warm runs reuse the command index and compiled parsers persisted by the cold runs.
+
+    python bench_parser.py coldstart --parser-dir ./src/genie/libs/parser --command "show version" \\
+        --output-file show_version.txt --network-os nxos
+
+Template matching: lookups against a few thousand parameterised cli_command templates, token trie vs the
+linear token-by-token comparison against every template.
+
+    python bench_parser.py templates --count 3000
+
+Suite: runs offline against a generated parser directory (many show_* modules with Schema classes and
+templated cli_commands) and a generated corpus of device outputs. It measures index build, cold and warm
+first lookups, cache hit throughput, oper_fill_tabular rows/s, build time and memory of dict vs columnar
+tables, batch throughput and template matching, and records the results as json. With --compare, metrics
+more than --tolerance worse than the baseline are reported and the exit status is 1.
+
+    python bench_parser.py suite --output bench_results.json
+    python bench_parser.py suite --compare bench_results.json
+"""
+import argparse
+import datetime
+import json
+import os
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List, Tuple
+
+from load_parser import ParserEngine, TemplateMatcher, oper_fill_tabular
+
+HERE = pathlib.Path(__file__).resolve().parent
+
+_FIRST_CALL = """
+import sys, time
+sys.path.insert(0, {here!r})
+start = time.perf_counter()
+from load_parser import ParserEngine
+app = ParserEngine({parser_dir!r}, cache_dir={cache_dir!r})
+app({command!r}, open({output_file!r}).read(), network_os={network_os!r})
+print(time.perf_counter() - start)
+"""
+
+
+def _first_call(parser_dir: str, cache_dir: str, command: str, output_file: str, network_os: str) -> float:
+    "Time engine creation plus the first parse in a new interpreter"
+    code = _FIRST_CALL.format(here=str(HERE), parser_dir=parser_dir, cache_dir=cache_dir, command=command,
+                              output_file=output_file, network_os=network_os)
+    result = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True)
+    return float(result.stdout.splitlines()[-1])
+
+
+def bench_cold_start(parser_dir: str, command: str, output_file: str, network_os: str = "nxos",
+                     runs: int = 5) -> Dict[str, float]:
+    "Median first call latency without and with the on-disk index and code cache"
+    cold: List[float] = []
+    warm: List[float] = []
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cold.append(_first_call(parser_dir, cache_dir, command, output_file, network_os))
+            warm.append(_first_call(parser_dir, cache_dir, command, output_file, network_os))
+    return {"cold_s": statistics.median(cold), "warm_s": statistics.median(warm),
+            "speedup": statistics.median(cold) / statistics.median(warm)}
+
+
+def _template_commands(count: int):
+    "Synthetic templates shaped like genie's, plus one matching command per template"
+    templates = []
+    commands = []
+    for i in range(count):
+        feature = "feature{}".format(i // 10)
+        shape = i % 10
+        if shape < 4:
+            templates.append("show {} detail{} interface {{interface}}".format(feature, shape))
+            commands.append("show {} detail{} interface Ethernet1/{}".format(feature, shape, i))
+        elif shape < 8:
+            templates.append("show ip {} vrf {{vrf}} summary{}".format(feature, shape))
+            commands.append("show ip {} vrf red{} summary{}".format(feature, i, shape))
+        else:
+            templates.append("show {} {{instance}} neighbor{} {{neighbor}}".format(feature, shape))
+            commands.append("show {} {} neighbor{} 10.0.0.{}".format(feature, i, shape, i % 255))
+    return templates, commands
+
+
+def _inner_command_check(cli_command_list, command_list) -> bool:
+    "Token by token comparison of a command with one template, the linear baseline of the template benchmark"
+    for supp_command, cli_command in zip(command_list, cli_command_list):
+        if '{' in cli_command:
+            if supp_command.strip() == "{}".format(supp_command.strip()):
+                continue
+            else:
+                return False
+        elif supp_command.strip() == cli_command.strip():
+            continue
+        else:
+            return False
+    return True
+
+
+def bench_templates(count: int = 3000, lookups: int = 20000) -> Dict[str, float]:
+    "Lookups per second of the template trie against the linear scan it replaces"
+    templates, commands = _template_commands(count)
+    matcher = TemplateMatcher()
+    start = time.perf_counter()
+    for template in templates:
+        matcher.add(template, template)
+    build_s = time.perf_counter() - start
+    probes = [commands[(i * 7919) % count] for i in range(lookups)]
+
+    start = time.perf_counter()
+    for command in probes:
+        assert matcher.match(command) is not None
+    trie_s = time.perf_counter() - start
+
+    linear_probes = probes[:max(1, lookups // 20)]
+    split_templates = [template.split() for template in templates]
+    start = time.perf_counter()
+    for command in linear_probes:
+        command_list = command.split()
+        for cli_command_list in split_templates:
+            if len(cli_command_list) == len(command_list) and _inner_command_check(cli_command_list, command_list):
+                break
+    linear_s = time.perf_counter() - start
+    trie_rate = lookups / trie_s
+    linear_rate = len(linear_probes) / linear_s
+    return {"templates": count, "build_s": build_s, "trie_lookups_per_s": trie_rate,
+            "linear_lookups_per_s": linear_rate, "speedup": trie_rate / linear_rate}
+
+
+_MODULE_HEADER = """\"\"\"{name}.py
+
+Synthetic parsers generated by bench_parser.py
+\"\"\"
+import re
+
+import genie.parsergen
+from genie.metaparser import MetaParser
+from genie.metaparser.util.schemaengine import Any, Optional
+
+"""
+
+_VERSION_PARSER = """
+# ======================================================
+# Schema for 'show {feature} version'
+# ======================================================
+class Show{Feature}VersionSchema(MetaParser):
+    \"\"\"Schema for show {feature} version\"\"\"
+    schema = {{
+        'platform': {{
+            'os': str,
+            Optional('hostname'): str,
+            Optional('software'): {{Any(): str}},
+        }}
+    }}
+
+
+# ======================================================
+# Parser for 'show {feature} version'
+# ======================================================
+class Show{Feature}Version(Show{Feature}VersionSchema):
+    \"\"\"Parser for show {feature} version\"\"\"
+
+    cli_command = ['show {feature} version',
+                   'show {feature} version {{option}}']
+
+    def cli(self, option='', output=None):
+        if output is None:
+            out = self.device.execute(self.cli_command)
+        else:
+            out = output
+
+        ret_dict = {{}}
+        # Cisco Nexus Operating System (NX-OS) Software
+        p1 = re.compile(r'^Cisco +Nexus +Operating +System +\\((?P<os>[\\w\\-]+)\\)')
+        #   NXOS: version 9.3(6)
+        p2 = re.compile(r'^(?P<name>\\w+): +version +(?P<version>\\S+)$')
+        #   Device name: leaf131
+        p3 = re.compile(r'^Device +name: +(?P<hostname>\\S+)$')
+        for line in out.splitlines():
+            line = line.strip()
+            m = p1.match(line)
+            if m:
+                ret_dict.setdefault('platform', {{}})['os'] = m.groupdict()['os']
+                continue
+            m = p2.match(line)
+            if m:
+                software = ret_dict.setdefault('platform', {{}}).setdefault('software', {{}})
+                software[m.groupdict()['name']] = m.groupdict()['version']
+                continue
+            m = p3.match(line)
+            if m:
+                ret_dict.setdefault('platform', {{}})['hostname'] = m.groupdict()['hostname']
+        return ret_dict
+
+"""
+
+_TABLE_PARSER = """
+# ======================================================
+# Schema for 'show {feature} switch'
+# ======================================================
+class Show{Feature}SwitchSchema(MetaParser):
+    \"\"\"Schema for show {feature} switch\"\"\"
+    schema = {{'switch': {{Any(): {{Any(): str}}}}}}
+
+
+# ======================================================
+# Parser for 'show {feature} switch'
+# ======================================================
+class Show{Feature}Switch(Show{Feature}SwitchSchema):
+    \"\"\"Parser for show {feature} switch\"\"\"
+
+    cli_command = ['show {feature} switch', 'show {feature} switch stack {{stack}}']
+
+    def cli(self, stack='', output=None):
+        if output is None:
+            out = self.device.execute(self.cli_command)
+        else:
+            out = output
+
+        table = genie.parsergen.oper_fill_tabular(right_justified=True,
+                                                  header_fields=["Switch#", "Role", "Mac Address", "Priority",
+                                                                 "Version", "State"],
+                                                  label_fields=["switch_num", "role", "mac_address", "priority",
+                                                                "hw_ver", "state"],
+                                                  index=[0],
+                                                  table_terminal_pattern=r"^\\s*$",
+                                                  device_output=out,
+                                                  device_os='iosxe')
+        return {{'switch': table.entries}}
+
+"""
+
+
+def generate_parser_tree(root: pathlib.Path, network_os: str = "nxos", modules: int = 100,
+                         features: int = 10) -> List[Tuple[str, str]]:
+    """Write a synthetic genie style parser directory, every module holds a version and a tabular parser
+    per feature, return the (command, kind) pairs it defines"""
+    directory = pathlib.Path(root, network_os)
+    directory.mkdir(parents=True, exist_ok=True)
+    commands = []
+    for module in range(modules):
+        name = "show_feature{}".format(module)
+        parts = [_MODULE_HEADER.format(name=name)]
+        for number in range(features):
+            feature = "f{}x{}".format(module, number)
+            parts.append(_VERSION_PARSER.format(feature=feature, Feature=feature.capitalize()))
+            parts.append(_TABLE_PARSER.format(feature=feature, Feature=feature.capitalize()))
+            commands.append(("show {} version".format(feature), "version"))
+            commands.append(("show {} switch".format(feature), "table"))
+        pathlib.Path(directory, name + ".py").write_text("".join(parts))
+    return commands
+
+
+def version_output(hostname: str = "leaf131") -> str:
+    return """Cisco Nexus Operating System (NX-OS) Software
+TAC support: http://www.cisco.com/tac
+Copyright (c) 2002-2020, Cisco Systems, Inc. All rights reserved.
+
+Software
+  BIOS: version 07.69
+  NXOS: version 9.3(6)
+  BIOS compile time:  04/08/2021
+  NXOS image file is: bootflash:///nxos.9.3.6.bin
+  NXOS compile time:  11/9/2020 23:00:00 [11/10/2020 11:00:21]
+
+Hardware
+  cisco Nexus9000 C9300v Chassis
+  Intel(R) Xeon(R) CPU E5-2678 v3 @ 2.50GHz with 8161040 kB of memory.
+  Processor Board ID 9AJ05VJPIV4
+
+  Device name: {}
+  bootflash:    4287040 kB
+Kernel uptime is 40 day(s), 20 hour(s), 55 minute(s), 10 second(s)
+""".format(hostname)
+
+
+def table_output(rows: int) -> str:
+    "A show switch style table with the supplied number of rows"
+    lines = ["Switch/Stack Mac Address : 0045.1d25.5e00 - Local Mac Address",
+             "Mac persistency wait time: Indefinite",
+             "                                             H/W   Current",
+             "Switch#   Role    Mac Address     Priority Version  State",
+             "-------------------------------------------------------------"]
+    for row in range(rows):
+        lines.append("{}{:<8}{:<9}{:04x}.{:04x}.{:04x}     {:<6} V07     {}".format(
+            "*" if row == 0 else " ", row + 1, "Active" if row == 0 else "Member", row >> 16, row & 0xffff,
+            row % 977, 15 - row % 15, "Ready" if row % 7 else "Provisioned"))
+    lines.append("")
+    return "\n".join(lines)
+
+
+def _best_rate(function, count: int, repeat: int = 3) -> float:
+    "Best of repeat runs of function, as count operations per second"
+    best = min(_timed(function) for _ in range(repeat))
+    return count / best
+
+
+def _timed(function) -> float:
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def bench_table_memory(rows: int = 100000, runs: int = 3) -> Dict[str, float]:
+    "Build time and retained memory of a table as nested dicts and as columns"
+    table = table_output(rows)
+    header_fields = ["Switch#", "Role", "Mac Address", "Priority", "Version", "State"]
+    label_fields = ["switch_num", "role", "mac_address", "priority", "hw_ver", "state"]
+    results = {}
+    for name, columnar in (("dict", False), ("columnar", True)):
+        results["{}_build_s".format(name)] = min(_timed(
+            lambda: oper_fill_tabular(True, header_fields, label_fields, [0], r"^\s*$", table, "iosxe",
+                                      columnar=columnar)) for _ in range(runs))
+        tracemalloc.start()
+        result = oper_fill_tabular(True, header_fields, label_fields, [0], r"^\s*$", table, "iosxe",
+                                   columnar=columnar)
+        results["{}_mb".format(name)] = tracemalloc.get_traced_memory()[0] / 1e6
+        tracemalloc.stop()
+        del result
+    return results
+
+
+def bench_suite(modules: int = 100, features: int = 10, table_rows: int = 20000, batch_jobs: int = 2000,
+                workers: int = 2, runs: int = 3, columnar_rows: int = 100000) -> Dict[str, float]:
+    "Run every benchmark against a generated parser tree and corpus"
+    results: Dict[str, float] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        parser_dir = pathlib.Path(tmp, "parser")
+        commands = generate_parser_tree(parser_dir, modules=modules, features=features)
+        version_command = commands[-2][0]
+        table_command = commands[-1][0]
+        show_version = version_output()
+        small_table = table_output(50)
+        output_file = pathlib.Path(tmp, "show_version.txt")
+        output_file.write_text(show_version)
+
+        cache_dir = pathlib.Path(tmp, "cache")
+        engine = ParserEngine(str(parser_dir), cache_dir=str(cache_dir))
+        results["index_build_s"] = _timed(lambda: engine.get_index("nxos"))
+        results["cold_lookup_s"] = _timed(lambda: engine(version_command, show_version))
+        warm = ParserEngine(str(parser_dir), cache_dir=str(cache_dir))
+        results["warm_lookup_s"] = _timed(lambda: warm(version_command, show_version))
+
+        hits = 2000
+        results["cache_hit_calls_per_s"] = _best_rate(
+            lambda: [engine(version_command, show_version) for _ in range(hits)], hits, runs)
+        engine(table_command, small_table)
+        results["table_calls_per_s"] = _best_rate(
+            lambda: [engine(table_command, small_table) for _ in range(200)], 200, runs)
+
+        big_table = table_output(table_rows)
+        header_fields = ["Switch#", "Role", "Mac Address", "Priority", "Version", "State"]
+        label_fields = ["switch_num", "role", "mac_address", "priority", "hw_ver", "state"]
+        results["tabular_rows_per_s"] = _best_rate(
+            lambda: oper_fill_tabular(True, header_fields, label_fields, [0], r"^\s*$", big_table, "iosxe"),
+            table_rows, runs)
+
+        jobs = [(command, show_version if kind == "version" else small_table)
+                for command, kind in (commands * (batch_jobs // len(commands) + 1))[:batch_jobs]]
+        results["batch_jobs_per_s"] = _best_rate(lambda: engine.parse_many(jobs, workers=workers),
+                                                 batch_jobs, 1)
+        engine.close()
+
+        start = bench_cold_start(str(parser_dir), version_command, str(output_file), runs=runs)
+        results["process_cold_start_s"] = start["cold_s"]
+        results["process_warm_start_s"] = start["warm_s"]
+    results.update(bench_table_memory(columnar_rows, runs))
+    templates = bench_templates(3000, 20000)
+    results["template_lookups_per_s"] = templates["trie_lookups_per_s"]
+    return results
+
+
+def compare(results: Dict[str, float], baseline: Dict[str, float], tolerance: float = 0.2) -> List[str]:
+    "Metrics more than tolerance worse than the baseline, *_per_s metrics should rise and *_s metrics fall"
+    regressions = []
+    for name, value in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            continue
+        if name.endswith("_per_s"):
+            worse = value < base * (1 - tolerance)
+        else:
+            worse = value > base * (1 + tolerance)
+        if worse:
+            regressions.append("{}: {:.6g} vs baseline {:.6g}".format(name, value, base))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="bench", required=True)
+    coldstart = sub.add_parser("coldstart", help="first call latency in a fresh process, cold vs warm cache")
+    coldstart.add_argument("--parser-dir", required=True)
+    coldstart.add_argument("--command", required=True)
+    coldstart.add_argument("--output-file", required=True)
+    coldstart.add_argument("--network-os", default="nxos")
+    coldstart.add_argument("--runs", type=int, default=5)
+    templates = sub.add_parser("templates", help="cli_command template matching, trie vs linear scan")
+    templates.add_argument("--count", type=int, default=3000)
+    templates.add_argument("--lookups", type=int, default=20000)
+    suite = sub.add_parser("suite", help="offline benchmark suite on a generated parser tree")
+    suite.add_argument("--modules", type=int, default=100)
+    suite.add_argument("--features", type=int, default=10, help="version and table parsers per module")
+    suite.add_argument("--table-rows", type=int, default=20000)
+    suite.add_argument("--columnar-rows", type=int, default=100000)
+    suite.add_argument("--batch-jobs", type=int, default=2000)
+    suite.add_argument("--workers", type=int, default=2)
+    suite.add_argument("--runs", type=int, default=3)
+    suite.add_argument("--output", help="write the results to this json file")
+    suite.add_argument("--compare", help="baseline json file written by a previous --output")
+    suite.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    if args.bench == "coldstart":
+        result = bench_cold_start(args.parser_dir, args.command, args.output_file, args.network_os, args.runs)
+    elif args.bench == "templates":
+        result = bench_templates(args.count, args.lookups)
+    elif args.bench == "suite":
+        result = {"meta": {"timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+                           "python": platform.python_version(), "platform": platform.platform(),
+                           "cpus": os.cpu_count(), "arguments": {k: v for k, v in vars(args).items()
+                                                                 if k not in ("output", "compare")}},
+                  "results": bench_suite(args.modules, args.features, args.table_rows, args.batch_jobs,
+                                         args.workers, args.runs, args.columnar_rows)}
+        if args.output:
+            pathlib.Path(args.output).write_text(json.dumps(result, indent=2))
+        if args.compare:
+            baseline = json.loads(pathlib.Path(args.compare).read_text())["results"]
+            result["regressions"] = compare(result["results"], baseline, args.tolerance)
+    print(json.dumps(result, indent=2))
+    if result.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
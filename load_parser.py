@@ -1,13 +1,42 @@
+import ast
+import asyncio
+import functools
+import hashlib
+import importlib.util
+import itertools
 import json
 import logging
+import marshal
+import mmap
+import os
 import pathlib
 import re
+import sys
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from pprint import pprint
-from typing import List, Optional, Tuple, Iterable, Dict, Union
+from typing import (Any, AsyncIterable, AsyncIterator, Callable, Hashable, List, Optional, TextIO, Tuple, Iterable,
+                    Iterator, Dict, Union, NamedTuple)
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_CACHE_DIR = pathlib.Path.home() / ".cache" / "hackgenieparser"
+INDEX_VERSION = 3
+CODE_CACHE_VERSION = 1
+
 
 class NameConflictError(BaseException):
     """Raise for errors in adding plugins due to the same name."""
@@ -21,7 +50,58 @@ class NoParserFilesFoundError(Exception):
     pass
 
 
+class StaleIndexError(Exception):
+    pass
+
+
+SERIALIZERS: Dict[str, Callable[[Any], Union[str, bytes]]] = {}
+# serializers producing a json document as str, usable for ndjson
+JSON_SERIALIZERS = {"json", "orjson"}
+
+
+def register_serializer(name: str, serializer: Callable[[Any], Union[str, bytes]], replace: bool = False):
+    """Add a result serializer, e.g. ParserEngine(serializer=name), raises NameConflictError when name is taken.
+    Serializers must be registered at import time to be available in batch worker processes."""
+    if name in SERIALIZERS and not replace:
+        raise NameConflictError("A serializer named {} is already registered".format(name))
+    SERIALIZERS[name] = serializer
+
+
+register_serializer("json", json.dumps)
+# the parser's own result, e.g. for parse_many callers that want dicts without a dumps/loads round trip
+register_serializer("native", lambda result: result)
+
+# genie style result with an int key, optional serializers have to round trip it before they are registered
+_SERIALIZER_PROBE = {"interfaces": {"Ethernet1/1": {"vlan": 10, "up": True, "mtu": 9216.0}}, 1: ["a", None]}
+
+
+def _register_checked(name: str, serializer: Callable[[Any], Union[str, bytes]], loads: Callable[[Any], Any],
+                      expected: Any):
+    "Register an optional serializer only when loads(serializer(_SERIALIZER_PROBE)) gives back expected"
+    try:
+        loaded = loads(serializer(_SERIALIZER_PROBE))
+    except Exception as e:
+        logger.warning("Not registering the {} serializer, it failed on a sample result: {}".format(name, e))
+        return
+    if loaded != expected:
+        logger.warning("Not registering the {} serializer, it does not round trip a sample result".format(name))
+        return
+    register_serializer(name, serializer)
+
+
+if orjson is not None:
+    # genie results may use int keys, which orjson only accepts with OPT_NON_STR_KEYS, they come back as str
+    _register_checked("orjson", lambda result: orjson.dumps(result, option=orjson.OPT_NON_STR_KEYS).decode(),
+                      orjson.loads, json.loads(json.dumps(_SERIALIZER_PROBE)))
+if msgpack is not None:
+    # packb accepts int keys as they are, unpackb needs strict_map_key=False to read them back
+    _register_checked("msgpack", msgpack.packb, functools.partial(msgpack.unpackb, strict_map_key=False),
+                      _SERIALIZER_PROBE)
+
+
 class tabular_object:
+    __slots__ = ("entries",)
+
     def __init__(self):
         self.entries: Dict = {}
 
@@ -29,119 +109,1494 @@ class tabular_object:
         return str(self.entries)
 
 
-def oper_fill_tabular(right_justified: bool, header_fields: Union[List, Tuple], label_fields: Union[List, Tuple],
-                      index: Union[List, Tuple], table_terminal_pattern:
-                    str, device_output: str, device_os: str):
-    table_entry = tabular_object()
+class columnar_tabular_object(tabular_object):
+    """Compact tabular result, one list of values per label field instead of one dict per row. Repeated values,
+    e.g. interface and state names, share one str object. entries builds the nested dict shape of
+    tabular_object on first access."""
+    __slots__ = ("fields", "key_fields", "columns", "_entries")
+
+    def __init__(self, fields: List[str], key_fields: List[str]):
+        self.fields = fields
+        self.key_fields = key_fields
+        self.columns: Dict[str, List[str]] = {field: [] for field in fields}
+        self._entries: Optional[Dict] = None
+
+    def __len__(self) -> int:
+        return len(self.columns[self.fields[0]])
+
+    def rows(self) -> Iterator[Dict[str, str]]:
+        "Iterate over the rows as {label: value} dicts, built one at a time"
+        fields = self.fields
+        return (dict(zip(fields, values)) for values in zip(*(self.columns[field] for field in fields)))
+
+    @property
+    def entries(self) -> Dict:
+        if self._entries is None:
+            entries: Dict = {}
+            nested_fields = self.key_fields[:-1]
+            key_field = self.key_fields[-1]
+            for row in self.rows():
+                level = entries
+                for field in nested_fields:
+                    level = level.setdefault(row[field], {})
+                level[row[key_field]] = row
+            self._entries = entries
+        return self._entries
+
+
+@functools.lru_cache(maxsize=256)
+def _tabular_regexes(header_fields: Tuple[str, ...], label_fields: Tuple[str, ...], table_terminal_pattern: str):
+    "Compiled header, row and terminator regexes of a table, cached per header/label signature"
     regex1 = r"\s*{}".format(header_fields[0].strip())
     for h in header_fields[1:]:
         regex1 = r"{}\s+{}".format(regex1, h.strip())
-    # regex1 = r"{}\s*[\n\r]".format(regex1)
-    print(regex1)
-    c_regex1 = re.compile(regex1)
-    headers_matched = False
-    for line in device_output.splitlines():
-        m1 = c_regex1.match(line)
-        if m1 and not headers_matched:
-            print(m1)
-            # [\*\s]\s+\d+\s +\d +\s + [\w\-]+\s + [\w\.\-\(\)]+\s + [\w\-]+\s +\w +)
-            regex2 = r"^(?P<{}>\*?\s*\S+)".format(label_fields[0].strip())
-            for f in label_fields[1:]:
-                regex2 = r"{}\s+(?P<{}>\S+)".format(regex2, f.strip())
-            regex2 = "{}$".format(regex2)
-            print(regex2)
-            c_regex2 = re.compile(regex2)
-            c_terminator = re.compile(table_terminal_pattern)
-            headers_matched = True
+    # [\*\s]\s+\d+\s +\d +\s + [\w\-]+\s + [\w\.\-\(\)]+\s + [\w\-]+\s +\w +)
+    regex2 = r"^(?P<{}>\*?\s*\S+)".format(label_fields[0].strip())
+    for f in label_fields[1:]:
+        regex2 = r"{}\s+(?P<{}>\S+)".format(regex2, f.strip())
+    regex2 = "{}$".format(regex2)
+    logger.debug("Table header regex {}, row regex {}".format(regex1, regex2))
+    return re.compile(regex1), re.compile(regex2), re.compile(table_terminal_pattern)
+
+
+def _index_fields(index: Union[List, Tuple], label_fields: Union[List, Tuple]) -> List[str]:
+    "Label names of the index columns, index holds label positions or label names"
+    fields = [label_fields[i].strip() if isinstance(i, int) else i.strip() for i in index or [0]]
+    for field in fields:
+        if field not in [f.strip() for f in label_fields]:
+            raise ValueError("Index field {} is not one of the label fields {}".format(field, label_fields))
+    return fields
+
+
+_LAZY_SPLIT_SIZE = 16 * 1024 * 1024
+
+
+class StreamedOutput:
+    """Device output read incrementally from a file path, mmap, bytes, binary or text file object or an iterable
+    of lines. Parsers looping over output.splitlines(), and oper_fill_tabular, consume it a line at a time so
+    peak memory does not depend on the size of the output. str methods, len, in, ==, + and truth testing read
+    the whole output, the re module does not accept it, parsers calling re on the output need str(output).
+    An iterator or file object source can only be consumed once."""
+    __slots__ = ("source",)
+
+    def __init__(self, source: Any):
+        self.source = source
+
+    def splitlines(self) -> Iterator[str]:
+        return _iter_lines(self.source)
+
+    def __iter__(self) -> Iterator[str]:
+        return _iter_lines(self.source)
+
+    def __str__(self) -> str:
+        return "\n".join(_iter_lines(self.source))
+
+    def __contains__(self, text: str) -> bool:
+        return text in str(self)
+
+    def __len__(self) -> int:
+        return len(str(self))
+
+    def __bool__(self) -> bool:
+        return bool(str(self))
+
+    def __eq__(self, other: Any) -> bool:
+        if isinstance(other, StreamedOutput):
+            other = str(other)
+        return str(self) == other
+
+    def __hash__(self) -> int:
+        return hash(str(self))
+
+    def __add__(self, other: str) -> str:
+        return str(self) + other
+
+    def __radd__(self, other: str) -> str:
+        return other + str(self)
+
+    def __getattr__(self, name: str):
+        if name == "source":
+            raise AttributeError(name)
+        return getattr(str(self), name)
+
+
+def _iter_lines(source: Any) -> Iterator[str]:
+    """Iterate over the lines of a device output without line endings, see StreamedOutput for the sources. Every
+    source is split as str.splitlines splits, so \r, \x0b, \x0c, \u2028 etc. end a line whatever the source and
+    size. The items of a file object or an iterable are split one at a time, an empty item is an empty line."""
+    if isinstance(source, StreamedOutput):
+        source = source.source
+    if isinstance(source, str):
+        if len(source) < _LAZY_SPLIT_SIZE:
+            return iter(source.splitlines())
+        return _iter_buffer_lines(source, "\n")
+    if isinstance(source, os.PathLike):
+        return _iter_file_lines(source)
+    if isinstance(source, (bytes, bytearray, mmap.mmap)):
+        return _iter_buffer_lines(source, b"\n")
+    return _iter_iterable_lines(source)
+
+
+def _iter_buffer_lines(buffer: Union[str, bytes, bytearray, mmap.mmap], newline: Union[str, bytes]
+                       ) -> Iterator[str]:
+    """Lines of a str or bytes like buffer, sliced one at a time instead of splitting the whole buffer. Every line
+    boundary lies at or before a \n, so splitting each \n terminated piece gives the lines of str.splitlines"""
+    position = 0
+    size = len(buffer)
+    while position < size:
+        end = buffer.find(newline, position)
+        end = size if end == -1 else end + 1
+        piece = buffer[position:end]
+        if not isinstance(piece, str):
+            piece = piece.decode(errors="replace")
+        yield from piece.splitlines()
+        position = end
+
+
+def _iter_file_lines(path: os.PathLike) -> Iterator[str]:
+    # binary, a text mode file would translate a bare \r before the split
+    with open(path, "rb") as fp:
+        for piece in fp:
+            yield from piece.decode(errors="replace").splitlines()
+
+
+def _iter_iterable_lines(lines: Iterable[Union[str, bytes]]) -> Iterator[str]:
+    "Lines of a file object or an iterable of lines, either may hold bytes"
+    for line in lines:
+        if not isinstance(line, str):
+            line = line.decode(errors="replace")
+        # an empty item is an empty line
+        yield from line.splitlines() or [""]
+
+
+def iter_tabular_rows(right_justified: bool, header_fields: Union[List, Tuple], label_fields: Union[List, Tuple],
+                      table_terminal_pattern: str, device_output: Any) -> Iterator[Dict[str, str]]:
+    """Yield the rows of the table following the header line in device_output as {label: value} dicts, reading
+    device_output a line at a time. device_output is a str or any StreamedOutput source. The table ends at the
+    first line that is not a row and matches table_terminal_pattern."""
+    return _iter_tabular(right_justified, header_fields, label_fields, table_terminal_pattern, device_output, True)
+
+
+def _iter_tabular(right_justified: bool, header_fields: Union[List, Tuple], label_fields: Union[List, Tuple],
+                  table_terminal_pattern: str, device_output: Any, as_dict: bool) -> Iterator:
+    "Rows of a table as {label: value} dicts or as lists of values in label order"
+    c_regex1, c_regex2, c_terminator = _tabular_regexes(tuple(header_fields), tuple(label_fields),
+                                                        table_terminal_pattern)
+    lines = _iter_lines(device_output)
+    for line in lines:
+        if c_regex1.match(line):
+            break
+    else:
+        return
+
+    labels = [f.strip() for f in label_fields]
+    first_field = labels[0]
+    width = len(labels)
+    row_match = c_regex2.match
+    terminator_match = c_terminator.match
+    for line in lines:
+        if right_justified:
+            line = line.lstrip()
+        tokens = line.split()
+        # a line of exactly one token per column without trailing whitespace is what the row regex matches,
+        # splitting it is cheaper than the regex, everything else goes through the regex
+        if len(tokens) == width and not line[-1].isspace():
+            yield dict(zip(labels, tokens)) if as_dict else tokens
             continue
-        elif headers_matched:
-            if right_justified:
-                line = line.lstrip()
-            m2 = c_regex2.match(line)
-            if m2:
-                print(line)
-                print(m2.groupdict())
-                table_entry.entries[m2.groupdict()['switch_num'].strip()] = {key: value.strip() for key, value in
-                                                               m2.groupdict().items()}
-                continue
-            m2 = c_terminator.match(line)
-            if m2:
-                break
+        m2 = row_match(line)
+        if m2:
+            # only the first column can hold whitespace, the optional * marker
+            if as_dict:
+                row = m2.groupdict()
+                row[first_field] = row[first_field].strip()
+            else:
+                row = list(m2.groups())
+                row[0] = row[0].strip()
+            yield row
+        elif terminator_match(line):
+            break
+
+
+def oper_fill_tabular(right_justified: bool, header_fields: Union[List, Tuple], label_fields: Union[List, Tuple],
+                      index: Union[List, Tuple], table_terminal_pattern:
+                    str, device_output: Any, device_os: str, columnar: bool = False):
+    """Fill a tabular_object with the rows of the table following the header line in device_output
 
-    print(table_entry)
+    Rows are keyed by the value of the index column, index holds label positions or label names, with more
+    than one index column the entries are nested one level per column. The table ends at the first line that
+    is not a row and matches table_terminal_pattern. device_output is a str or any StreamedOutput source,
+    it is read a line at a time, see iter_tabular_rows to also consume the rows as they are found.
+    With columnar a columnar_tabular_object is returned, which only builds entries when they are accessed.
+
+    Throughput target: 400k rows/s or more for a six column table on CPython 3.11, measured by
+    bench_parser.py suite as tabular_rows_per_s.
+    """
+    key_fields = _index_fields(index, label_fields)
+    if columnar:
+        return _fill_columnar(right_justified, header_fields, label_fields, key_fields, table_terminal_pattern,
+                              device_output)
+    table_entry = tabular_object()
+    entries = table_entry.entries
+    nested_fields = key_fields[:-1]
+    key_field = key_fields[-1]
+    rows = iter_tabular_rows(right_justified, header_fields, label_fields, table_terminal_pattern, device_output)
+    if not nested_fields:
+        entries.update((row[key_field], row) for row in rows)
+        return table_entry
+    for row in rows:
+        level = entries
+        for field in nested_fields:
+            level = level.setdefault(row[field], {})
+        level[row[key_field]] = row
     return table_entry
 
 
-def _outer_command_check(cli_command_list, command):
-    command_list = command.split()
-    print(f"outer: {command_list}")
-    for command_str in cli_command_list:
-        cli_command_str_split = command_str.split()
-        if '{' in command_str and len(cli_command_str_split) == len(command_list) and _inner_command_check(
-                cli_command_str_split, command_list):
-            return True
-    return False
+_COLUMNAR_BLOCK = 256
 
 
-def _inner_command_check(cli_command_list, command_list) -> bool:
-    for supp_command, cli_command in zip(command_list, cli_command_list):
-        if '{' in cli_command:
-            if supp_command.strip() == "{}".format(supp_command.strip()):
-                continue
-            else:
-                return False
-        elif supp_command.strip() == cli_command.strip():
+def _fill_columnar(right_justified: bool, header_fields: Union[List, Tuple], label_fields: Union[List, Tuple],
+                   key_fields: List[str], table_terminal_pattern: str, device_output: Any
+                   ) -> columnar_tabular_object:
+    table_entry = columnar_tabular_object([f.strip() for f in label_fields], key_fields)
+    columns = [table_entry.columns[field] for field in table_entry.fields]
+    # one memo per column, repeated values are stored once, the memos are dropped with the build
+    memos: List[Dict[str, str]] = [{} for _ in columns]
+    rows = _iter_tabular(right_justified, header_fields, label_fields, table_terminal_pattern, device_output,
+                         False)
+    while True:
+        # transpose a block of rows at a time, keeps the per value work out of the python loop
+        block = list(itertools.islice(rows, _COLUMNAR_BLOCK))
+        if not block:
+            break
+        for column, memo, values in zip(columns, memos, zip(*block)):
+            column.extend(map(memo.setdefault, values, values))
+    return table_entry
+
+
+class CaptureSection(NamedTuple):
+    command: str
+    hostname: Optional[str]
+    output: str
+
+
+# commands whose output becomes a section, any other command at a prompt only ends the current section
+CAPTURE_COMMANDS = re.compile(r"(?:show|ping)\b")
+CAPTURE_PATTERNS = [
+    # leaf131# show version, Router(config)#show ip route, a bare prompt ends the previous section
+    re.compile(r"^(?P<hostname>[\w.\-/:]+)(?:\([\w\-]+\))?[#>]\s*(?P<command>\S.*?)?\s*$"),
+    # ------------------ show version ------------------ (IOS/IOS-XE show tech)
+    re.compile(r"^-{3,}\s*(?P<command>(?:show|ping)\b.*?)\s*-{3,}\s*$"),
+    # `show version` (NX-OS show tech)
+    re.compile(r"^`(?P<command>(?:show|ping)\b[^`]*)`\s*$"),
+]
+
+
+def split_capture(capture: Any, patterns: Optional[List] = None) -> Iterator[CaptureSection]:
+    """Split a capture of several commands, e.g. show tech or a scripted session, into one section per command,
+    in a single pass over its lines. capture is a str or any StreamedOutput source. A line matching one of the
+    patterns, CAPTURE_PATTERNS by default, starts a new section when its command group is a show or ping command,
+    the hostname is learned from such prompts only. A prompt without a command, or with another command such as
+    terminal length 0, only ends the current section when its hostname is the learned one, so in a banner
+    delimited capture, and for output lines like Switch#  Role, it is kept as output."""
+    patterns = CAPTURE_PATTERNS if patterns is None else patterns
+    command = None
+    hostname = None
+    lines: List[str] = []
+    for line in _iter_lines(capture):
+        for pattern in patterns:
+            match = pattern.match(line)
+            if match:
+                break
+        else:
+            if command is not None:
+                lines.append(line)
+            continue
+        groups = match.groupdict()
+        next_command = groups.get("command")
+        if next_command:
+            next_command = " ".join(next_command.split())
+        prompt_hostname = groups.get("hostname")
+        next_hostname = hostname
+        if next_command and CAPTURE_COMMANDS.match(next_command):
+            next_hostname = prompt_hostname or hostname
+        elif prompt_hostname is not None and prompt_hostname != hostname:
+            # not a prompt of the device, or the capture has no prompts at all
+            if command is not None:
+                lines.append(line)
             continue
         else:
+            next_command = None
+        if command is not None:
+            yield CaptureSection(command, hostname, "\n".join(lines))
+        command = next_command
+        hostname = next_hostname
+        lines = []
+    if command is not None:
+        yield CaptureSection(command, hostname, "\n".join(lines))
+
+
+AUTO_OS = "auto"
+FINGERPRINT_PREFIX = 4096
+# first match wins, IOS-XE and IOS-XR banners also mention Cisco IOS Software so ios comes last
+OS_FINGERPRINTS = [
+    ("nxos", re.compile(r"Cisco Nexus Operating System|\bNX-OS\b|^\s*NXOS: version", re.MULTILINE)),
+    ("iosxr", re.compile(r"Cisco IOS[ -]XR Software|\bIOS-XR\b")),
+    ("iosxe", re.compile(r"Cisco IOS[ -]XE Software|\bIOS-XE\b")),
+    ("ios", re.compile(r"Cisco IOS Software|Cisco Internetwork Operating System Software")),
+]
+
+
+def _output_prefix(output: Any, size: int) -> Optional[str]:
+    "The first size characters of a command output, None for sources that can't be read without consuming them"
+    if isinstance(output, StreamedOutput):
+        output = output.source
+    if isinstance(output, str):
+        return output[:size]
+    if isinstance(output, (bytes, bytearray, mmap.mmap)):
+        return bytes(output[:size]).decode(errors="replace")
+    if isinstance(output, os.PathLike):
+        with open(output, "rb") as f:
+            return f.read(size).decode(errors="replace")
+    if hasattr(output, "read") and hasattr(output, "seekable") and output.seekable():
+        position = output.tell()
+        prefix = output.read(size)
+        output.seek(position)
+        return prefix.decode(errors="replace") if isinstance(prefix, bytes) else prefix
+    return None
+
+
+def detect_network_os(output: Any, prefix: int = FINGERPRINT_PREFIX,
+                      fingerprints: Optional[List[Tuple[str, Any]]] = None) -> Optional[str]:
+    """Fingerprint the network os from the first prefix characters of a command output, e.g. the show version
+    banner, returns None when no fingerprint matches"""
+    text = _output_prefix(output, prefix)
+    if not text:
+        return None
+    for network_os, pattern in OS_FINGERPRINTS if fingerprints is None else fingerprints:
+        if pattern.search(text):
+            return network_os
+    return None
+
+
+_PLACEHOLDER_RE = re.compile(r"\{(\w*)\}")
+
+
+class TemplateMatcher:
+    """Token trie over parameterised cli_command templates. A token containing a {placeholder} matches any
+    supplied token, literal tokens are tried before placeholders and a dead end backtracks to the placeholder
+    branch. Every trie node is visited at most once, so a lookup never costs more than the templates sharing a
+    prefix with the command, typically a few nodes per token. The worst case, templates with both a literal and a
+    placeholder at every position, is exponential in the number of tokens."""
+
+    def __init__(self):
+        self.root: Dict = {}
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, template: str, value: Any):
+        "Add a template, the first value added for a template wins"
+        node = self.root
+        placeholders = []
+        for position, token in enumerate(template.split()):
+            if '{' in token:
+                placeholders.append((position, token))
+                node = node.setdefault(None, {})
+            else:
+                node = node.setdefault(token, {})
+        if "" not in node:
+            # the empty string can never be a token after split, so it marks the end of a template
+            node[""] = (template, value, placeholders)
+            self.size += 1
+
+    def match(self, command: str) -> Optional[Tuple[str, Any, Dict[str, str]]]:
+        "Return (template, value, arguments) for the supplied command or None"
+        tokens = command.split()
+        found = self._match(self.root, tokens, 0)
+        if found is None:
+            return None
+        template, value, placeholders = found
+        return template, value, _template_arguments(placeholders, tokens)
+
+    def _match(self, node: Dict, tokens: List[str], position: int):
+        if position == len(tokens):
+            return node.get("")
+        child = node.get(tokens[position])
+        if child is not None:
+            found = self._match(child, tokens, position + 1)
+            if found is not None:
+                return found
+        child = node.get(None)
+        if child is not None:
+            return self._match(child, tokens, position + 1)
+        return None
+
+
+def _template_arguments(placeholders: List[Tuple[int, str]], tokens: List[str]) -> Dict[str, str]:
+    "Extract the placeholder values, e.g. {'interface': 'Ethernet1/1'} from 'show interface {interface}'"
+    arguments = {}
+    for position, token in placeholders:
+        names = _PLACEHOLDER_RE.findall(token)
+        value = tokens[position]
+        if len(names) == 1 and names[0]:
+            prefix, _, suffix = _PLACEHOLDER_RE.sub("{}", token).partition("{}")
+            if value.startswith(prefix) and value.endswith(suffix) and len(value) >= len(prefix) + len(suffix):
+                value = value[len(prefix):len(value) - len(suffix)]
+            arguments[names[0]] = value
+    return arguments
+
+
+class IndexEntry(NamedTuple):
+    command: str
+    class_name: str
+    start: int
+    end: int
+    digest: str
+    module: str
+
+
+def _scan_module(cmd_module: pathlib.Path) -> List[Tuple[str, str, int, int, str]]:
+    """Parse a parser module once and return (cli_command, class name, first line, last line, source digest) for
+    every Schema derived class, line numbers are 1-based and inclusive"""
+    try:
+        source = cmd_module.read_text()
+        if "cli_command" not in source:
+            return []
+        tree = ast.parse(source, filename=str(cmd_module))
+    except (OSError, UnicodeDecodeError, SyntaxError, ValueError) as e:
+        logger.warning("Unable to scan {}: {}".format(cmd_module, e))
+        return []
+    lines = source.splitlines()
+    entries = []
+    for node in tree.body:
+        # the class statement must be class Name(NameSchema): for _alter_class to strip the schema
+        if not (isinstance(node, ast.ClassDef) and len(node.bases) == 1 and isinstance(node.bases[0], ast.Name)
+                and node.bases[0].id.endswith("Schema")):
+            continue
+        commands = []
+        for statement in node.body:
+            if isinstance(statement, ast.Assign):
+                targets = statement.targets
+            elif isinstance(statement, ast.AnnAssign) and statement.value is not None:
+                targets = [statement.target]
+            else:
+                continue
+            if any(isinstance(target, ast.Name) and target.id == "cli_command" for target in targets):
+                commands.extend(_literal_commands(statement.value))
+        if not commands:
+            continue
+        digest = _source_digest("\n".join(lines[node.lineno - 1:node.end_lineno]) + "\n")
+        entries.extend((command, node.name, node.lineno, node.end_lineno, digest) for command in commands)
+    return entries
+
+
+def _class_source(cmd_module: pathlib.Path, start: int, end: int) -> str:
+    "Return the source of the class spanning lines start to end of a parser module"
+    lines = cmd_module.read_text().splitlines()
+    return "\n".join(lines[start - 1:end]) + "\n"
+
+
+def _source_digest(parser_class: str) -> str:
+    return hashlib.sha256(parser_class.encode()).hexdigest()
+
+
+def _literal_commands(value: ast.expr) -> List[str]:
+    "Evaluate the right hand side of a cli_command statement into a list of command strings"
+    try:
+        value = ast.literal_eval(value)
+    except ValueError:
+        return []
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, (list, tuple)):
+        return [v for v in value if isinstance(v, str)]
+    return []
+
+
+class CommandIndex:
+    """Maps every cli_command string or template of one network os to the module, class and source span
+    implementing it. The index is persisted as json and a module is only rescanned when its mtime or size changes."""
+
+    def __init__(self, path: pathlib.Path, index_file: Optional[pathlib.Path] = None):
+        self.path = path
+        self.index_file = index_file
+        self.files: Dict[str, Dict] = {}
+        self.commands: Dict[str, IndexEntry] = {}
+        self.templates = TemplateMatcher()
+
+    def load(self) -> bool:
+        "Load a previously persisted index, returns False when there is none or it is unusable"
+        if not self.index_file or not self.index_file.exists():
+            return False
+        try:
+            data = json.loads(self.index_file.read_text())
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable command index {}: {}".format(self.index_file, e))
             return False
-    return True
+        if data.get("version") != INDEX_VERSION or data.get("path") != str(self.path.resolve()):
+            return False
+        self.files = data["files"]
+        self._build_lookup()
+        return True
+
+    def refresh(self, files: List[pathlib.Path], executor: Optional[Executor] = None) -> List[str]:
+        """Rescan added or modified modules, drop removed ones, return the names of the modules that changed.
+        The modules are scanned in executor when one is given, e.g. a process pool for a large cold index."""
+        changed = []
+        current = {}
+        stale = []
+        for file in files:
+            stat = file.stat()
+            record = self.files.get(file.name)
+            if record and record["mtime_ns"] == stat.st_mtime_ns and record["size"] == stat.st_size:
+                current[file.name] = record
+                continue
+            stale.append((file, stat))
+        to_scan = [file for file, _ in stale]
+        scans = executor.map(_scan_module, to_scan, chunksize=16) if executor else map(_scan_module, to_scan)
+        for (file, stat), entries in zip(stale, scans):
+            current[file.name] = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "entries": entries}
+            changed.append(file.name)
+        changed.extend(name for name in self.files if name not in current)
+        self.files = current
+        if changed:
+            logger.debug("Command index for {} rebuilt for {}".format(self.path, changed))
+            self._build_lookup()
+            self.save()
+        return changed
+
+    def save(self):
+        if not self.index_file:
+            return
+        data = {"version": INDEX_VERSION, "path": str(self.path.resolve()), "files": self.files}
+        try:
+            self.index_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = self.index_file.with_suffix(".{}.tmp".format(os.getpid()))
+            tmp_file.write_text(json.dumps(data))
+            os.replace(tmp_file, self.index_file)
+        except OSError as e:
+            logger.warning("Unable to persist command index {}: {}".format(self.index_file, e))
+
+    def _build_lookup(self):
+        commands = {}
+        templates = TemplateMatcher()
+        for module, record in sorted(self.files.items()):
+            for values in record["entries"]:
+                entry = IndexEntry(*values, module)
+                commands.setdefault(entry.command, entry)
+                if '{' in entry.command:
+                    templates.add(entry.command, entry)
+        self.commands = commands
+        self.templates = templates
+
+    def lookup(self, command: str) -> Optional[IndexEntry]:
+        "Find the index entry for a supplied command, exact commands first and then cli_command templates"
+        found = self.match(command)
+        return found[0] if found else None
+
+    def match(self, command: str) -> Optional[Tuple[IndexEntry, Dict[str, str]]]:
+        "Find the index entry for a supplied command and the values of the template placeholders"
+        entry = self.commands.get(command)
+        if entry:
+            return entry, {}
+        found = self.templates.match(command)
+        if found is None:
+            return None
+        _, entry, arguments = found
+        return entry, arguments
+
+    def class_source(self, entry: IndexEntry) -> str:
+        """Return the source of the parser class referenced by an index entry, raises StaleIndexError when the
+        module changed since it was indexed and the span no longer holds the class with the indexed digest"""
+        source = _class_source(pathlib.Path(self.path, entry.module), entry.start, entry.end)
+        if _source_digest(source) != entry.digest:
+            raise StaleIndexError("{} changed since it was indexed".format(entry.module))
+        return source
+
+
+class CodeCache:
+    """On-disk cache of altered and compiled parser classes, stored as marshalled code objects keyed by
+    the class source digest and the bytecode magic number of the running interpreter"""
+
+    def __init__(self, directory: pathlib.Path):
+        self.directory = directory
+        self.tag = "{}-{}".format(importlib.util.MAGIC_NUMBER.hex(), CODE_CACHE_VERSION)
+
+    def __contains__(self, digest: str) -> bool:
+        return self._code_file(digest).exists()
+
+    def _code_file(self, digest: str) -> pathlib.Path:
+        return pathlib.Path(self.directory, "{}-{}.marshal".format(digest, self.tag))
+
+    def get(self, digest: str):
+        try:
+            return marshal.loads(self._code_file(digest).read_bytes())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, EOFError, TypeError) as e:
+            logger.warning("Ignoring unreadable compiled parser {}: {}".format(self._code_file(digest), e))
+            return None
+
+    def put(self, digest: str, code):
+        code_file = self._code_file(digest)
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            tmp_file = code_file.with_suffix(".{}.tmp".format(os.getpid()))
+            tmp_file.write_bytes(marshal.dumps(code))
+            os.replace(tmp_file, code_file)
+        except OSError as e:
+            logger.warning("Unable to persist compiled parser {}: {}".format(code_file, e))
+
+
+class ParserCache:
+    """Bounded LRU cache of parser instances, safe for concurrent use. Concurrent misses for the same key
+    wait for a single build instead of building the parser once per thread."""
+
+    def __init__(self, maxsize: Optional[int] = 512):
+        """
+
+        :param maxsize: maximum number of parser instances kept, None for no limit
+        :type maxsize: int
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._building: Dict[Hashable, Future] = {}
+        # bumped by discard_if, a build that started before a discard is returned but not cached
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable) -> Any:
+        "Return the cached value for key or None, a lookup that is not found is not counted as a miss"
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+        return None
+
+    def get_or_build(self, key: Hashable, builder: Callable[[], Any]) -> Any:
+        "Return the cached value for key, calling builder once on a miss"
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            future = self._building.get(key)
+            owner = future is None
+            if owner:
+                future = self._building[key] = Future()
+            generation = self._generation
+        if not owner:
+            return future.result()
+        try:
+            value = builder()
+        except BaseException as e:
+            with self._lock:
+                del self._building[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            if generation == self._generation:
+                self._entries[key] = value
+            del self._building[key]
+            while self.maxsize is not None and len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        future.set_result(value)
+        return value
+
+    def discard_if(self, predicate: Callable[[Hashable, Any], bool]) -> List[Hashable]:
+        "Remove the entries for which predicate(key, value) is true, return their keys"
+        with self._lock:
+            keys = [key for key, value in self._entries.items() if predicate(key, value)]
+            for key in keys:
+                del self._entries[key]
+            self._generation += 1
+        return keys
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Optional[int]]:
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "size": len(self._entries), "maxsize": self.maxsize}
+
+
+class ResultCache:
+    """Cache of serialised parse results for repeated, byte identical outputs. Keyed by a blake2b digest of
+    (command, network_os, output), bounded by a memory budget and an optional time to live."""
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, ttl: Optional[float] = 300.0):
+        """
+
+        :param max_bytes: approximate memory budget of the cached results, least recently used are evicted first
+        :type max_bytes: int
+        :param ttl: seconds a result stays valid, None to keep results until evicted
+        :type ttl: float
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(command: str, network_os: str, output: str) -> bytes:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(command.encode())
+        digest.update(b"\0")
+        digest.update(network_os.encode())
+        digest.update(b"\0")
+        digest.update(output.encode())
+        return digest.digest()
+
+    def get(self, key: bytes) -> Optional[Union[str, bytes]]:
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expires, size, value = item
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                self.size_bytes -= size
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: bytes, value: Union[str, bytes]):
+        size = sys.getsizeof(value) + sys.getsizeof(key)
+        if size > self.max_bytes:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous:
+                self.size_bytes -= previous[1]
+            self._entries[key] = (expires, size, value)
+            self.size_bytes += size
+            while self.size_bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self.size_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate, "evictions": self.evictions,
+                "expirations": self.expirations, "entries": len(self._entries), "size_bytes": self.size_bytes,
+                "max_bytes": self.max_bytes}
+
+
+class PhaseTiming(NamedTuple):
+    phase: str
+    command: Optional[str]
+    network_os: str
+    seconds: float
+
+
+class PhaseMetrics:
+    """Metrics callback for ParserEngine(metrics=...), aggregates count, total and max seconds per
+    (network_os, command, phase), e.g. to see which parsers and which phases dominate collection latency.
+
+    Phases: list_dir, index, detect_os, find_command, find_class, alter_class, code_cache, exec, result_cache, parse,
+    serialize, preload
+    """
+
+    def __init__(self):
+        self.phases: Dict[Tuple[str, Optional[str], str], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, timing: PhaseTiming):
+        key = (timing.network_os, timing.command, timing.phase)
+        with self._lock:
+            totals = self.phases.get(key)
+            if totals is None:
+                self.phases[key] = [1, timing.seconds, timing.seconds]
+            else:
+                totals[0] += 1
+                totals[1] += timing.seconds
+                if timing.seconds > totals[2]:
+                    totals[2] = timing.seconds
+
+    def summary(self) -> List[Dict]:
+        "Aggregated timings, largest total first"
+        with self._lock:
+            rows = [{"network_os": network_os, "command": command, "phase": phase, "count": count,
+                     "total_s": total, "max_s": maximum}
+                    for (network_os, command, phase), (count, total, maximum) in self.phases.items()]
+        return sorted(rows, key=lambda row: row["total_s"], reverse=True)
+
+
+class BuiltParser(NamedTuple):
+    parser: Any
+    entry: IndexEntry
+    arguments: Dict[str, str]
+
+
+class ParseResult(NamedTuple):
+    index: int
+    command: str
+    network_os: str
+    result: Optional[str]
+    error: Optional[str]
+
+
+class PreloadReport(NamedTuple):
+    network_os: str
+    seconds: float
+    built: List[str]
+    # command: error message
+    failed: Dict[str, str]
+
+
+_worker_engine: Optional["ParserEngine"] = None
+
+
+def _init_worker(parser_dir: str, cache_dir: str, code_cache: bool, serializer: str, stream_output: bool):
+    "Process pool initializer, every worker keeps its own engine and so its own warmed parser cache"
+    global _worker_engine
+    _worker_engine = ParserEngine(parser_dir, cache_dir=cache_dir, code_cache=code_cache, serializer=serializer,
+                                  stream_output=stream_output)
+
+
+def _job_fields(job: Tuple[str, ...]) -> Tuple[str, str, str]:
+    "Unpack a (command, output) or (command, output, network_os) job"
+    return job[0], job[1], job[2] if len(job) > 2 else "nxos"
+
+
+def _error_message(e: Exception) -> str:
+    return "{}: {}".format(type(e).__name__, e)
+
+
+def _worker_parse(command: str, output: str, network_os: str) -> str:
+    return _worker_engine(command, output, network_os)
+
+
+def _worker_compile(path: str, entry: IndexEntry):
+    "Compile the parser class of an index entry in a worker, the code is handed back through the code cache"
+    _worker_engine._compile_parser(CommandIndex(pathlib.Path(path)), entry)
+
+
+def _parse_chunk(chunk: List[Tuple[int, str, str, str]]) -> List[ParseResult]:
+    "Parse a chunk of jobs in a worker, failures are reported per job"
+    results = []
+    for index, command, output, network_os in chunk:
+        try:
+            result = _worker_engine(command, output, network_os)
+        except Exception as e:
+            results.append(ParseResult(index, command, network_os, None, _error_message(e)))
+        else:
+            results.append(ParseResult(index, command, network_os, result, None))
+    return results
 
 
 class ParserEngine:
     # We are going to find and execute a parser for a command output
-    def __init__(self, parser_dir: str = r"./src/genie/libs/parser"):
+    def __init__(self, parser_dir: str = r"./src/genie/libs/parser", cache_dir: Optional[str] = None,
+                 code_cache: bool = True, cache_size: Optional[int] = 512,
+                 result_cache: Optional[ResultCache] = None, serializer: str = "json",
+                 metrics: Optional[Callable[[PhaseTiming], None]] = None, stream_output: bool = False):
+        """
+
+        :param parser_dir: root of the parser directory structure, one directory per network os
+        :type parser_dir: str
+        :param cache_dir: directory for the persisted command indexes and compiled parsers,
+            defaults to ~/.cache/hackgenieparser
+        :type cache_dir: str
+        :param code_cache: persist compiled parser classes so later processes skip extraction and compilation
+        :type code_cache: bool
+        :param cache_size: maximum number of parser instances kept in memory, None for no limit
+        :type cache_size: int
+        :param result_cache: optional cache returning the stored result for outputs that were already parsed, only
+            serialised str or bytes results are cached, so it can't be combined with the native serializer
+        :type result_cache: ResultCache
+        :param serializer: name of the registered serializer used by __call__, json, native, or orjson and msgpack
+            if installed
+        :type serializer: str
+        :param metrics: called with a PhaseTiming for every phase of every call, e.g. a PhaseMetrics instance,
+            the timings are also logged at debug level
+        :type metrics: callable
+        :param stream_output: hand outputs that are not a str, e.g. a file path, to the parsers as a StreamedOutput
+            instead of reading them into a str first, only for parsers that consume the output line by line
+        :type stream_output: bool
+        """
+        if serializer not in SERIALIZERS:
+            raise ValueError("Unknown serializer {}, available: {}".format(serializer, sorted(SERIALIZERS)))
+        if result_cache is not None and serializer == "native":
+            # every hit would hand out the same mutable result
+            raise ValueError("A result cache needs a serializer returning str or bytes, not native")
         self.parser_directory = parser_dir
-        self.cache = {}
+        self.cache_dir = pathlib.Path(cache_dir) if cache_dir else DEFAULT_CACHE_DIR
+        self.cache = ParserCache(cache_size)
+        self.result_cache = result_cache
+        self.serializer = serializer
+        self._serialize = SERIALIZERS[serializer]
+        self.metrics = metrics
+        self.stream_output = stream_output
+        self.indexes: Dict[str, CommandIndex] = {}
+        self._index_lock = threading.Lock()
+        # network os per device key, learned by network_os="auto"
+        self.device_os: Dict[str, str] = {}
+        self._persisted: Optional[Dict[str, CommandIndex]] = None
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_workers: Optional[int] = None
+        # batches running on a pool, a replaced pool is shut down when its count drops to 0
+        self._pool_users: Dict[ProcessPoolExecutor, int] = {}
+        self._pool_lock = threading.Lock()
+        self._watcher: Optional[threading.Thread] = None
+        self._stop_watching = threading.Event()
+        self.code_cache = CodeCache(pathlib.Path(self.cache_dir, "code")) if code_cache else None
 
-    def __call__(self, command: str, output: str, network_os: str = "nxos") -> str:
+    def __call__(self, command: str, output: Any, network_os: str = "nxos", device: Optional[str] = None) -> str:
         """
 
         :param command: cli command, needs to match the command in the class cli_command = statement
         :type command: str
-        :param output: command output to be parsed
+        :param output: command output to be parsed, a str or a file path, mmap, bytes, file object or iterable of
+            lines which is read into a str, or handed to the parser as a StreamedOutput with stream_output
         :type output: str
-        :param network_os: network operating system, needs to match directory name in parser directory structure
+        :param network_os: network operating system, needs to match directory name in parser directory structure,
+            or "auto" to detect it, see resolve_network_os
         :type network_os: str
-        :return: parsed output
+        :param device: device key, e.g. the hostname, the network os detected with "auto" is remembered per device
+        :type device: str
+        :return: parsed output, serialised by the engine's serializer
         :rtype: json str
         """
+        network_os = self.resolve_network_os(command, output, network_os, device)
+
+        cached = self.result_cache is not None and isinstance(output, str)
+        if cached:
+            start = time.perf_counter()
+            key = ResultCache.key(command, network_os, output)
+            result = self.result_cache.get(key)
+            self._record("result_cache", command, network_os, start)
+            if result is not None:
+                return result
+        parsed = self.parse(command, output, network_os)
+        start = time.perf_counter()
+        result = self._serialize(parsed)
+        self._record("serialize", command, network_os, start)
+        if cached and isinstance(result, (str, bytes)):
+            self.result_cache.put(key, result)
+        return result
+
+    def parse(self, command: str, output: Any, network_os: str = "nxos", device: Optional[str] = None) -> Dict:
+        "Parse a command output and return the parser's native result, without serialising it"
+        network_os = self.resolve_network_os(command, output, network_os, device)
+        built = self._get_built(command, network_os)
+        if not isinstance(output, str):
+            # unmodified genie parsers expect a str, e.g. they call re.search on it
+            output = StreamedOutput(output) if self.stream_output else str(StreamedOutput(output))
+        start = time.perf_counter()
+        # template placeholders are passed to cli() as keyword arguments, as genie does
+        result = built.parser.cli(output=output, **built.arguments)
+        self._record("parse", command, network_os, start)
+        return result
 
-        key_value = (command, network_os)
-        if key_value in self.cache:
-            print("Cache Hit")
-            return json.dumps(self.cache[key_value].cli(output))
-        path = pathlib.Path(self.parser_directory, network_os)
-        files: List[pathlib.Path] = self._get_parser_modules(path)
-        if not files:
-            raise NoParserFilesFoundError("No files found at {}".format(path))
-        print(files)
-        cmd_module = self._find_command(command, files)
-        if not cmd_module:
+    def get_parser(self, command: str, network_os: str = "nxos"):
+        "Return the parser instance for the supplied command, it is built on first use and then cached"
+        return self._get_built(command, network_os).parser
+
+    def _get_built(self, command: str, network_os: str) -> BuiltParser:
+        return self.cache.get_or_build((command, network_os), lambda: self._build_parser(command, network_os))
+
+    def _build_parser(self, command: str, network_os: str) -> BuiltParser:
+        "Locate, compile and instantiate a parser class in a namespace of its own"
+        index = self.get_index(network_os)
+        start = time.perf_counter()
+        found = index.match(command)
+        self._record("find_command", command, network_os, start)
+        if not found:
             raise ModuleNotFoundError("Parser Module for {} not found!".format(command))
-        print(cmd_module)
-        parser_name, parser_class = self._find_class(command, cmd_module)
-        if not parser_name:
-            raise ParserNotFoundError("Parser Class for {} not found in {}!".format(command, cmd_module))
-        print(parser_name)
-        #print(parser_class)
+        entry, arguments = found
+        logger.debug("Parser for {} on {}: {}".format(command, network_os, entry))
+        try:
+            code = self._compile_parser(index, entry, command, network_os)
+        except StaleIndexError as e:
+            # the module was edited after it was indexed, rescan the changed modules and look the command up again
+            logger.info("Reloading the command index of {}: {}".format(network_os, e))
+            self.reload()
+            found = index.match(command)
+            if not found:
+                raise ModuleNotFoundError("Parser Module for {} not found!".format(command))
+            entry, arguments = found
+            code = self._compile_parser(index, entry, command, network_os)
+        parser_name = entry.class_name
+        start = time.perf_counter()
+        # parser classes rely on the names of this module, e.g. re and oper_fill_tabular
+        namespace = dict(globals())
+        exec(code, namespace)
+        parser = namespace[parser_name]()
+        self._record("exec", command, network_os, start)
+        return BuiltParser(parser, entry, arguments)
+
+    def resolve_network_os(self, command: str, output: Any, network_os: str = AUTO_OS,
+                           device: Optional[str] = None) -> str:
+        """Return network_os unless it is "auto". Otherwise use the network os remembered for device, else
+        fingerprint the output prefix with detect_network_os, else take the network os whose loaded or persisted
+        command index knows the command, ParserNotFoundError is raised when none or several do. Parser modules are
+        never scanned to find the network os.
+
+        :param command: cli command
+        :type command: str
+        :param output: command output, see __call__
+        :type output: str
+        :param network_os: network operating system or "auto"
+        :type network_os: str
+        :param device: device key the detected network os is remembered for
+        :type device: str
+        :return: network operating system
+        :rtype: str
+        """
+        if network_os != AUTO_OS:
+            return network_os
+        if device is not None:
+            known = self.device_os.get(device)
+            if known is not None:
+                return known
+        start = time.perf_counter()
+        detected = detect_network_os(output)
+        if detected is not None and not pathlib.Path(self.parser_directory, detected).is_dir():
+            logger.debug("Detected {} for {} but there is no parser directory for it".format(detected, command))
+            detected = None
+        candidates = []
+        if detected is None:
+            candidates = sorted(name for name, index in self._known_indexes() if index.match(command))
+            if len(candidates) == 1:
+                detected = candidates[0]
+        self._record("detect_os", command, detected or AUTO_OS, start)
+        if detected is None:
+            if candidates:
+                # picking one would depend on which indexes happen to be loaded
+                raise ParserNotFoundError("Unable to determine the network os for {}, the output has no known "
+                                          "fingerprint and the command exists for {}".format(command,
+                                                                                            ", ".join(candidates)))
+            raise ParserNotFoundError("Unable to determine the network os for {}".format(command))
+        if device is not None:
+            self.device_os[device] = detected
+        return detected
+
+    def _known_indexes(self) -> Iterator[Tuple[str, CommandIndex]]:
+        "The loaded command indexes, then the indexes persisted by earlier runs for the other network os"
+        loaded = dict(self.indexes)
+        yield from loaded.items()
+        if self._persisted is None:
+            persisted = {}
+            try:
+                directories = [d for d in pathlib.Path(self.parser_directory).iterdir() if d.is_dir()]
+            except OSError as e:
+                logger.debug("Unable to list {}: {}".format(self.parser_directory, e))
+                directories = []
+            for directory in sorted(directories):
+                index = CommandIndex(directory, self._index_file(directory))
+                if index.load():
+                    persisted[directory.name] = index
+            self._persisted = persisted
+        for name, index in self._persisted.items():
+            if name not in loaded:
+                yield name, index
+
+    def _record(self, phase: str, command: Optional[str], network_os: str, start: float):
+        "Report the time spent in a phase since start to the metrics callback and the debug log"
+        seconds = time.perf_counter() - start
+        if self.metrics is not None:
+            self.metrics(PhaseTiming(phase, command, network_os, seconds))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("{} {} {}: {:.6f}s".format(network_os, command, phase, seconds))
+
+    def imap(self, jobs: Iterable[Tuple[str, ...]], workers: Optional[int] = None, ordered: bool = True,
+             chunk_size: int = 64) -> Iterator[ParseResult]:
+        """Parse many command outputs across a pool of worker processes
+
+        :param jobs: (command, output) or (command, output, network_os) tuples
+        :type jobs: iterable
+        :param workers: number of worker processes, defaults to the number of cpus, the pool and the parsers its
+            workers built are kept for later calls until close()
+        :type workers: int
+        :param ordered: yield results in job order, otherwise as they complete
+        :type ordered: bool
+        :param chunk_size: maximum number of jobs sent to a worker at once, jobs in a chunk share (command, network_os)
+        :type chunk_size: int
+        :return: one ParseResult per job, result is the json str or error describes the failure
+        :rtype: iterator
+        """
+        executor = self._acquire_pool(workers)
+        groups: Dict[Tuple[str, str], List[Tuple[int, str, str, str]]] = {}
+        futures = []
+        seen_os = {AUTO_OS}
+        try:
+            for index, job in enumerate(jobs):
+                command, output, network_os = _job_fields(job)
+                if network_os not in seen_os:
+                    seen_os.add(network_os)
+                    # build and persist the command index once, so the workers only load it
+                    try:
+                        self.get_index(network_os)
+                    except Exception as e:
+                        logger.debug("Command index for {} not available: {}".format(network_os, e))
+                group = groups.setdefault((command, network_os), [])
+                group.append((index, command, output, network_os))
+                # a full chunk goes to the workers while the rest of the jobs is still being read
+                if len(group) >= chunk_size:
+                    futures.append(executor.submit(_parse_chunk, groups.pop((command, network_os))))
+            futures.extend(executor.submit(_parse_chunk, group) for group in groups.values())
+            groups.clear()
+            if not ordered:
+                for future in as_completed(futures):
+                    yield from future.result()
+                return
+            pending: Dict[int, ParseResult] = {}
+            next_index = 0
+            for future in as_completed(futures):
+                for result in future.result():
+                    pending[result.index] = result
+                while next_index in pending:
+                    yield pending.pop(next_index)
+                    next_index += 1
+        except BrokenProcessPool:
+            self._discard_pool(executor)
+            raise
+        finally:
+            # the pool outlives this call, don't leave the chunks of an abandoned iteration queued
+            for future in futures:
+                future.cancel()
+            self._release_pool(executor)
+
+    def parse_capture(self, capture: Any, network_os: str = "nxos", workers: Optional[int] = None,
+                      processes: bool = False, patterns: Optional[List] = None) -> Dict[str, ParseResult]:
+        """Split a capture of several commands with split_capture and parse every section concurrently
+
+        :param capture: device capture, a str or any StreamedOutput source
+        :type capture: str
+        :param network_os: network operating system of the device, or "auto" to detect it per section, the
+            hostname of the prompt is the device key
+        :type network_os: str
+        :param workers: number of threads, or worker processes with processes
+        :type workers: int
+        :param processes: parse in worker processes instead of threads, for cpu heavy captures
+        :type processes: bool
+        :param patterns: section patterns for split_capture, defaults to CAPTURE_PATTERNS
+        :type patterns: list
+        :return: ParseResult per command in capture order, index is the section number, commands without a
+            parser have an error, a repeated command keeps its last section
+        :rtype: dict
+        """
+        results: Dict[int, ParseResult] = {}
+        jobs = []
+        futures = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # sections are handed to the threads as they are split off, parsing overlaps reading the capture
+            for number, section in enumerate(split_capture(capture, patterns)):
+                try:
+                    section_os = self.resolve_network_os(section.command, section.output, network_os,
+                                                         section.hostname)
+                    if self.get_index(section_os).match(section.command) is None:
+                        raise ModuleNotFoundError("Parser Module for {} not found!".format(section.command))
+                except (ModuleNotFoundError, ParserNotFoundError, NoParserFilesFoundError) as e:
+                    results[number] = ParseResult(number, section.command, network_os, None, _error_message(e))
+                    continue
+                if processes:
+                    jobs.append((number, section.command, section.output, section_os))
+                else:
+                    futures[number] = (section.command, section_os,
+                                       executor.submit(self, section.command, section.output, section_os))
+            for number, (command, section_os, future) in futures.items():
+                try:
+                    results[number] = ParseResult(number, command, section_os, future.result(), None)
+                except Exception as e:
+                    results[number] = ParseResult(number, command, section_os, None, _error_message(e))
+        if jobs:
+            parsed = self.imap([job[1:] for job in jobs], workers=workers)
+            for job, result in zip(jobs, parsed):
+                results[job[0]] = result._replace(index=job[0])
+        return {result.command: result for _, result in sorted(results.items())}
+
+    def parse_many(self, jobs: Iterable[Tuple[str, ...]], workers: Optional[int] = None,
+                   chunk_size: int = 64) -> List[ParseResult]:
+        "Parse many command outputs across a pool of worker processes, see imap, results are in job order"
+        return list(self.imap(jobs, workers=workers, chunk_size=chunk_size))
+
+    def write_ndjson(self, jobs: Iterable[Tuple[str, ...]], fp: TextIO, workers: Optional[int] = None,
+                     chunk_size: int = 64) -> int:
+        """Parse many command outputs across a pool of worker processes and stream them to fp as ndjson, one
+        {"index", "command", "network_os", "result", "error"} object per line in job order. The serialised
+        results are written as they are, nothing is built up in memory.
+
+        :return: number of lines written
+        :rtype: int
+        """
+        if self.serializer not in JSON_SERIALIZERS:
+            raise ValueError("ndjson needs a json serializer, the engine uses {}".format(self.serializer))
+        count = 0
+        for parsed in self.imap(jobs, workers=workers, chunk_size=chunk_size):
+            fp.write('{{"index": {}, "command": {}, "network_os": {}, "result": {}, "error": {}}}\n'.format(
+                parsed.index, json.dumps(parsed.command), json.dumps(parsed.network_os),
+                parsed.result if parsed.error is None else "null", json.dumps(parsed.error)))
+            count += 1
+        return count
+
+    def _process_pool(self, workers: Optional[int] = None) -> ProcessPoolExecutor:
+        "Process pool whose workers run their own engine with this engine's settings"
+        initargs = (self.parser_directory, str(self.cache_dir), self.code_cache is not None, self.serializer,
+                    self.stream_output)
+        return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs)
+
+    def _acquire_pool(self, workers: Optional[int] = None) -> ProcessPoolExecutor:
+        """The engine's process pool, kept across calls so the workers keep their warmed parsers until close(),
+        it is replaced when a different number of workers is asked for. Every acquire needs a _release_pool."""
+        retired = None
+        with self._pool_lock:
+            if self._pool is not None and workers is not None and workers != self._pool_workers:
+                retired = self._detach_pool()
+            if self._pool is None:
+                self._pool = self._process_pool(workers)
+                self._pool_workers = workers
+            pool = self._pool
+            self._pool_users[pool] = self._pool_users.get(pool, 0) + 1
+        if retired is not None:
+            retired.shutdown(wait=False)
+        return pool
+
+    def _release_pool(self, pool: ProcessPoolExecutor):
+        "End a batch on pool, a pool that was replaced meanwhile is shut down by its last batch"
+        with self._pool_lock:
+            self._pool_users[pool] -= 1
+            if self._pool_users[pool]:
+                return
+            del self._pool_users[pool]
+            if pool is self._pool:
+                return
+        pool.shutdown(wait=False)
+
+    def _discard_pool(self, pool: Optional[ProcessPoolExecutor] = None):
+        """Replace the shared pool, only if it is still pool when one is given. Batches running on it keep
+        submitting to it, it is shut down when the last of them ends, the next batch starts a new pool."""
+        with self._pool_lock:
+            if self._pool is None or (pool is not None and self._pool is not pool):
+                return
+            retired = self._detach_pool()
+        if retired is not None:
+            retired.shutdown(wait=False)
+
+    def _detach_pool(self) -> Optional[ProcessPoolExecutor]:
+        "Detach the shared pool, called with _pool_lock held, returns it when no batch uses it and it can go"
+        pool, self._pool = self._pool, None
+        return None if self._pool_users.get(pool) else pool
+
+    def close(self):
+        "Stop the worker processes and the reload watcher"
+        self._discard_pool()
+        self.stop_watching()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def preload(self, network_os: str, commands: Optional[Iterable[str]] = None, workers: Optional[int] = None,
+                processes: bool = False) -> PreloadReport:
+        """Build parsers up front instead of on their first call, e.g. before the first poll cycle after a deploy
+
+        :param network_os: network operating system to preload
+        :type network_os: str
+        :param commands: commands to build, defaults to every command of network_os without template
+            placeholders, templated commands are cached per concrete command so list those explicitly
+        :type commands: iterable
+        :param workers: number of threads building the parsers, and of worker processes with processes
+        :type workers: int
+        :param processes: scan the modules of a cold index and compile the parser classes in worker processes,
+            they hand the compiled classes back through the code cache, so this needs code_cache
+        :type processes: bool
+        :return: the time taken, the commands built and the error per command that failed
+        :rtype: PreloadReport
+        """
+        start = time.perf_counter()
+        if processes and self.code_cache is None:
+            logger.warning("Preloading {} in threads, worker processes need the code cache".format(network_os))
+            processes = False
+        pool = self._acquire_pool(workers) if processes else None
+        try:
+            index = self.get_index(network_os, pool)
+            if commands is None:
+                commands = [command for command in index.commands if '{' not in command]
+            commands = list(dict.fromkeys(commands))
+            if pool is not None:
+                entries = {}
+                for command in commands:
+                    found = index.match(command)
+                    if found and found[0].digest not in self.code_cache:
+                        entries[found[0].digest] = found[0]
+                # compile failures surface again, and are reported, when the parser is built below
+                for future in [pool.submit(_worker_compile, str(index.path), entry) for entry in entries.values()]:
+                    future.exception()
+        finally:
+            if pool is not None:
+                self._release_pool(pool)
+        if self.cache.maxsize is not None and len(commands) > self.cache.maxsize:
+            logger.warning("Preloading {} parsers for {} into a cache of {}, the first ones will be evicted".format(
+                len(commands), network_os, self.cache.maxsize))
+        built = []
+        failed = {}
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [(command, executor.submit(self._get_built, command, network_os)) for command in commands]
+            for command, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    failed[command] = _error_message(e)
+                else:
+                    built.append(command)
+        seconds = time.perf_counter() - start
+        self._record("preload", None, network_os, start)
+        logger.info("Preloaded {} parsers for {} in {:.3f}s, {} failed".format(len(built), network_os, seconds,
+                                                                              len(failed)))
+        return PreloadReport(network_os, seconds, built, failed)
+
+    def get_index(self, network_os: str, executor: Optional[Executor] = None) -> CommandIndex:
+        """Return the command index for the supplied network os, loading or building it on first use, the
+        modules that need a scan are scanned in executor when one is given"""
+        index = self.indexes.get(network_os)
+        if index is not None:
+            return index
+        with self._index_lock:
+            index = self.indexes.get(network_os)
+            if index is None:
+                path = pathlib.Path(self.parser_directory, network_os)
+                start = time.perf_counter()
+                files: List[pathlib.Path] = self._get_parser_modules(path)
+                self._record("list_dir", None, network_os, start)
+                if not files:
+                    raise NoParserFilesFoundError("No files found at {}".format(path))
+                start = time.perf_counter()
+                index = CommandIndex(path, self._index_file(path))
+                index.load()
+                index.refresh(files, executor)
+                self._record("index", None, network_os, start)
+                self.indexes[network_os] = index
+        return index
+
+    def reload(self) -> Dict[str, List[str]]:
+        """Pick up added, modified and removed parser modules of every loaded network os. Only the changed
+        modules are rescanned, and only the cached parsers whose command now resolves differently are dropped,
+        in-flight parses keep the parser they started with.
+
+        :return: names of the changed modules per network os
+        :rtype: dict
+        """
+        changes = {}
+        # persisted indexes of other network os are only used to resolve "auto", pick them up again lazily
+        self._persisted = None
+        with self._index_lock:
+            for network_os, index in list(self.indexes.items()):
+                try:
+                    files = self._get_parser_modules(index.path)
+                except OSError as e:
+                    logger.warning("Unable to list {}: {}".format(index.path, e))
+                    continue
+                changed = index.refresh(files)
+                if changed:
+                    changes[network_os] = changed
+                    self._invalidate(network_os, index)
+        if changes:
+            # the workers cache parsers of their own, the next batch starts workers that see the changes
+            self._discard_pool()
+        return changes
+
+    def _invalidate(self, network_os: str, index: CommandIndex):
+        "Drop the cached parsers of network_os whose command no longer resolves to the same class"
+
+        def stale(key: Tuple[str, str], built: BuiltParser) -> bool:
+            command, key_os = key
+            if key_os != network_os:
+                return False
+            found = index.match(command)
+            if not found:
+                return True
+            entry, arguments = found
+            return (entry.module, entry.class_name, entry.digest, arguments) != (
+                built.entry.module, built.entry.class_name, built.entry.digest, built.arguments)
+
+        dropped = self.cache.discard_if(stale)
+        logger.info("Parser modules changed for {}, dropped cached parsers {}".format(network_os, dropped))
+        if dropped and self.result_cache is not None:
+            # results are not tracked per parser, drop them all rather than serve results of an old parser
+            self.result_cache.clear()
+
+    def start_watching(self, interval: float = 5.0):
+        "Poll the loaded parser directories for changes every interval seconds in a daemon thread"
+        if self._watcher is not None and self._watcher.is_alive():
+            return
+        self._stop_watching.clear()
+        self._watcher = threading.Thread(target=self._watch, args=(interval,), name="parser-reload", daemon=True)
+        self._watcher.start()
+
+    def stop_watching(self):
+        self._stop_watching.set()
+        if self._watcher is not None:
+            self._watcher.join()
+            self._watcher = None
+
+    def _watch(self, interval: float):
+        while not self._stop_watching.wait(interval):
+            try:
+                self.reload()
+            except Exception:
+                logger.exception("Reloading the parser directory failed")
+
+    def _compile_parser(self, index: CommandIndex, entry: IndexEntry, command: Optional[str] = None,
+                        network_os: str = ""):
+        "Return the code object defining the parser class of an index entry, from the code cache when possible"
+        if self.code_cache:
+            start = time.perf_counter()
+            code = self.code_cache.get(entry.digest)
+            self._record("code_cache", command, network_os, start)
+            if code is not None:
+                return code
+        start = time.perf_counter()
+        parser_class = index.class_source(entry)
+        self._record("find_class", command, network_os, start)
+        start = time.perf_counter()
         parser_class = self._alter_class(parser_class)
-        #print(parser_class)
-        exec(parser_class, globals(), globals())
-        exec("p = {}()".format(parser_name), globals(), globals())
-        self.cache[key_value] = p
+        code = compile(parser_class, "<{}:{}>".format(entry.module, entry.class_name), "exec")
+        self._record("alter_class", command, network_os, start)
+        if self.code_cache:
+            self.code_cache.put(entry.digest, code)
+        return code
 
-        result = p.cli(output=output)
-        return json.dumps(result)
+    def _index_file(self, path: pathlib.Path) -> pathlib.Path:
+        "Location of the persisted command index, one file per parser directory"
+        digest = hashlib.sha1(str(path.resolve()).encode()).hexdigest()[:12]
+        return pathlib.Path(self.cache_dir, "index-{}-{}.json".format(path.name, digest))
 
     def _get_parser_modules(self, path: pathlib.Path) -> List[pathlib.Path]:
         """Retrieve the list of parser modules for the supplied network os"""
@@ -149,90 +1604,6 @@ class ParserEngine:
                  f.name.startswith('show_') or f.name.startswith('ping')]
         return files
 
-    def _find_command(self, command: str, files: List[pathlib.Path], regex1: str=r"[\'\"](show.*?)[\'\"]") -> Optional[pathlib.Path]:
-        "find the parser module containing the supplied command"
-        c_regex1 = re.compile(regex1)
-        for file in files:
-            file_text = file.read_text()
-            list_of_commands = c_regex1.findall(file_text)
-            # print(list_of_commands)
-            if command in list_of_commands:
-                return file
-            else:
-                for cli_command in list_of_commands:
-                    command_list = command.split()
-                    cli_command_list = cli_command.split()
-                    if '{' in cli_command and len(command_list) == len(cli_command_list):
-                        for supp_command, cli_command in zip(command_list, cli_command_list):
-                            if '{' in cli_command:
-                                if supp_command.strip() == "{}".format(supp_command.strip()):
-                                    continue
-                                else:
-                                    break
-                            elif supp_command == cli_command:
-                                continue
-                            else:
-                                break
-                        else:
-                            return file
-
-    def _find_class(self, command: str, cmd_module: pathlib.Path, regex1: str=r"(class\s+?\w+)\((\w+?Schema)\):",
-                    regex2: str=r"cli_command\s+?=\s+?['\"]{}['\"]") -> Optional[Tuple[str, str]]:
-        "Find the parser class and return the name of the class and the string"
-        regex2 = regex2.format(command)
-        c_regex1 = re.compile(regex1)
-        c_regex2 = re.compile(regex2)
-        c_regex2_2 = re.compile(r"cli_command\s+?=\s+?(?P<cli_command_string>\[.*$)")
-        c_regex2_3 = re.compile(r"(?P<cli_command_string>.*\])")
-        present_class = None
-        cli_command_flag = False
-        cli_command_string = ""
-        for line in cmd_module.read_text().splitlines():
-            if cli_command_flag:
-                #print("command flag")
-                #print(line)
-                match = c_regex2_3.search(line)
-                if match:
-                    cli_command_flag = False
-                    cli_command_string = "{} {}".format(cli_command_string, match.groupdict()["cli_command_string"])
-                    #print(f"match 2_3: {cli_command_string}")
-                    cli_command_list = eval(cli_command_string)
-                    print(f"cli_command: {cli_command_list}")
-                    if command in cli_command_list:
-                        break
-                    elif _outer_command_check(cli_command_list, command):
-                        break
-                    cli_command_string = ""
-                else:
-                    cli_command_string = "{} {}".format(cli_command_string, line.strip())
-                    #print(f"inter line: {cli_command_string}")
-            match = c_regex1.search(line)
-            if match:
-                present_class = match
-                continue
-            match = c_regex2.search(line)
-            if match:
-                break
-            match = c_regex2_2.search(line)
-            if match:
-                #print(f"match 2_2: {match.groupdict()}")
-                cli_command_string = match.groupdict()["cli_command_string"]
-                if "]" not in cli_command_string:
-                    cli_command_flag = True
-                else:
-                    cli_command_list = eval(cli_command_string)
-                    if command in cli_command_list:
-                        break
-                    elif _outer_command_check(cli_command_list, command):
-                        break
-        else:
-            return None
-        regex3 = r"({}\({}\):\s+.*?return\s+\S+[\n\r])[\n\r]+?(?:class|#)".format(present_class.group(1), present_class.group(2))
-        c_regex3 = re.compile(regex3, re.S)
-        match = c_regex3.search(cmd_module.read_text())
-        print(match.groups())
-        return present_class.group(1).split()[1], match.group(1)
-
     def _alter_class(self, parser_class: str, regex1: str=r"class\s+?\w+(\(\w+?Schema\)):"):
         "Alter the found parser class, so it can run, remove schema, remove call to device object"
         c_regex1 = re.compile(regex1)
@@ -248,8 +1619,126 @@ class ParserEngine:
         return parser_class
 
 
+class AsyncParserEngine:
+    """asyncio front end for a ParserEngine. Parser discovery runs in a thread so the event loop never blocks on
+    file scans, concurrent discoveries of the same parser are coalesced, and parsing runs in an executor."""
+
+    def __init__(self, engine: Optional[ParserEngine] = None, executor: Optional[Executor] = None,
+                 process_workers: Optional[int] = None, **kwargs):
+        """
+
+        :param engine: engine to front, by default one is created from the remaining keyword arguments
+        :type engine: ParserEngine
+        :param executor: executor for discovery and parsing, defaults to the event loop's default executor
+        :type executor: Executor
+        :param process_workers: parse in a pool of this many worker processes instead, for cpu heavy outputs
+        :type process_workers: int
+        """
+        # an engine created here is closed by close(), one that was passed in belongs to the caller
+        self._owns_engine = engine is None
+        self.engine = engine or ParserEngine(**kwargs)
+        self.executor = executor
+        self.process_pool = self.engine._process_pool(process_workers) if process_workers else None
+        self._discovery: Dict[Tuple[str, str], asyncio.Future] = {}
+
+    async def get_parser(self, command: str, network_os: str = "nxos"):
+        "Return the parser instance for the supplied command, discovering and building it off the event loop"
+        key = (command, network_os)
+        built = self.engine.cache.get(key)
+        if built is not None:
+            return built.parser
+        future = self._discovery.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(self.executor, self.engine.get_parser,
+                                                                command, network_os)
+            self._discovery[key] = future
+            future.add_done_callback(lambda f: self._discovery.pop(key, None))
+        # shielded, a cancelled caller must not cancel the discovery other callers are waiting on
+        return await asyncio.shield(future)
+
+    async def aparse(self, command: str, output: str, network_os: str = "nxos", device: Optional[str] = None) -> str:
+        """Parse a command output without blocking the event loop
+
+        :param command: cli command, needs to match the command in the class cli_command = statement
+        :type command: str
+        :param output: command output to be parsed
+        :type output: str
+        :param network_os: network operating system, needs to match directory name in parser directory structure,
+            or "auto" to detect it
+        :type network_os: str
+        :param device: device key the detected network os is remembered for
+        :type device: str
+        :return: parsed output
+        :rtype: json str
+        """
+        loop = asyncio.get_running_loop()
+        if network_os == AUTO_OS:
+            network_os = self.engine.device_os.get(device, AUTO_OS) if device is not None else AUTO_OS
+        if network_os == AUTO_OS:
+            # detection may read the output file and the persisted command indexes, keep it off the event loop
+            network_os = await loop.run_in_executor(self.executor, self.engine.resolve_network_os, command, output,
+                                                    AUTO_OS, device)
+        if self.process_pool:
+            return await loop.run_in_executor(self.process_pool, _worker_parse, command, output, network_os)
+        await self.get_parser(command, network_os)
+        return await loop.run_in_executor(self.executor, self.engine, command, output, network_os)
+
+    async def aparse_stream(self, jobs: Union[AsyncIterable[Tuple[str, ...]], Iterable[Tuple[str, ...]]]
+                            ) -> AsyncIterator[ParseResult]:
+        """Parse jobs as they arrive and yield results as they complete
+
+        :param jobs: (command, output) or (command, output, network_os) tuples, e.g. fed by device sessions
+        :type jobs: async iterable or iterable
+        :return: one ParseResult per job, index is the position of the job in jobs
+        :rtype: async iterator
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+
+        async def parse(index: int, job: Tuple[str, ...]):
+            command, output, network_os = _job_fields(job)
+            try:
+                result = await self.aparse(command, output, network_os)
+            except Exception as e:
+                await queue.put(ParseResult(index, command, network_os, None, _error_message(e)))
+            else:
+                await queue.put(ParseResult(index, command, network_os, result, None))
+
+        async def feed():
+            tasks = []
+            try:
+                if hasattr(jobs, "__aiter__"):
+                    index = 0
+                    async for job in jobs:
+                        tasks.append(asyncio.ensure_future(parse(index, job)))
+                        index += 1
+                else:
+                    for index, job in enumerate(jobs):
+                        tasks.append(asyncio.ensure_future(parse(index, job)))
+                await asyncio.gather(*tasks)
+            finally:
+                await queue.put(None)
+
+        feeder = asyncio.ensure_future(feed())
+        try:
+            while True:
+                result = await queue.get()
+                if result is None:
+                    break
+                yield result
+            await feeder
+        finally:
+            feeder.cancel()
+
+    def close(self):
+        if self.process_pool:
+            self.process_pool.shutdown()
+        if self._owns_engine:
+            self.engine.close()
+
+
 if __name__ == '__main__':
-    app = ParserEngine()
+    metrics = PhaseMetrics()
+    app = ParserEngine(metrics=metrics)
 
     show_ver = """Cisco Nexus Operating System (NX-OS) Software
     TAC support: http://www.cisco.com/tac
@@ -483,4 +1972,6 @@ if __name__ == '__main__':
 10.100.128.206    0   FULL/  -        00:00:37    10.100.132.146  TenGigabitEthernet0/1/0"""
     start = time.time()
     pprint(app("show ip ospf neighbor", show_o_neigh, network_os="iosxe"))
-    end = time.time()
\ No newline at end of file
+    end = time.time()
+
+    pprint(metrics.summary())
@@ -0,0 +1,446 @@
+"""Long running parse service
+
+Keeps one ParserEngine warm, the command indexes and parsers of the preloaded network os are built at start up,
+so a request only pays for cli(). Requests are json objects, responses carry the parsed result as json.
+
+Unix socket, one request per line and one response per line in request order (ndjson). A client may write many
+requests before reading the responses:
+
+    {"op": "parse", "id": 1, "command": "show version", "output": "...", "network_os": "nxos"}
+    {"op": "parse_many", "id": 2, "jobs": [["show version", "...", "nxos"], ["show inventory", "..."]]}
+    {"op": "stats", "id": 3}
+
+HTTP on localhost, POST /parse and POST /parse_many with the same json body, GET /stats. Connections are kept
+alive.
+
+    python parse_service.py serve --parser-dir ./src/genie/libs/parser --preload nxos iosxe \\
+        --socket /tmp/hackgenieparser.sock --http 127.0.0.1:8765
+    python parse_service.py parse --socket /tmp/hackgenieparser.sock --command "show version" \\
+        --output-file show_version.txt
+"""
+import argparse
+import http.client
+import http.server
+import json
+import logging
+import os
+import pathlib
+import socket
+import socketserver
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from load_parser import (JSON_SERIALIZERS, ParserEngine, ParseResult, PreloadReport, ResultCache, _error_message,
+                         _job_fields)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET = "/tmp/hackgenieparser.sock"
+
+
+class ParseServiceError(Exception):
+    pass
+
+
+class ParseService:
+    "Handles parse requests against a warm engine, shared by the unix socket and the http server"
+
+    def __init__(self, engine: ParserEngine, preload: Iterable[str] = (), workers: Optional[int] = None,
+                 processes: bool = False):
+        """
+
+        :param engine: engine serving the requests, its serializer has to produce json, e.g. json or orjson
+        :type engine: ParserEngine
+        :param preload: network os whose parsers are built before the first request
+        :type preload: iterable
+        :param workers: threads, or processes, building the preloaded parsers, see ParserEngine.preload
+        :type workers: int
+        :param processes: scan and compile the preloaded parsers in worker processes
+        :type processes: bool
+        """
+        if engine.serializer not in JSON_SERIALIZERS:
+            raise ValueError("The parse service needs a json serializer, not {}".format(engine.serializer))
+        self.engine = engine
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self.preloaded: Dict[str, PreloadReport] = {}
+        for network_os in preload:
+            self.warm(network_os, workers=workers, processes=processes)
+
+    def warm(self, network_os: str, commands: Optional[Iterable[str]] = None, workers: Optional[int] = None,
+             processes: bool = False) -> PreloadReport:
+        "Build the parsers of network_os, every command without template placeholders by default"
+        report = self.engine.preload(network_os, commands, workers=workers, processes=processes)
+        for command, error in report.failed.items():
+            logger.warning("Unable to build the parser for {} on {}: {}".format(command, network_os, error))
+        self.preloaded[network_os] = report
+        return report
+
+    def handle(self, request: Dict) -> str:
+        "Run one request and return the json response"
+        op = request.get("op", "parse")
+        with self._lock:
+            self.requests += 1
+        try:
+            if op == "parse":
+                body = '"result": ' + self._parse(request)
+            elif op == "parse_many":
+                body = '"results": [' + ", ".join(self._parse_many(request.get("jobs", ()))) + ']'
+            elif op == "stats":
+                body = '"result": ' + json.dumps(self.stats())
+            else:
+                raise ParseServiceError("Unknown op {}".format(op))
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+            body = '"error": ' + json.dumps(_error_message(e))
+        return '{"id": ' + json.dumps(request.get("id")) + ', ' + body + '}'
+
+    def handle_line(self, line: Union[str, bytes]) -> str:
+        "Run one ndjson request line"
+        try:
+            # UnicodeDecodeError is a ValueError, a bad line only fails its own request
+            request = json.loads(line.decode() if isinstance(line, bytes) else line)
+            if not isinstance(request, dict):
+                raise ValueError("request is not a json object")
+        except ValueError as e:
+            with self._lock:
+                self.requests += 1
+                self.errors += 1
+            return '{"id": null, "error": ' + json.dumps(_error_message(e)) + '}'
+        return self.handle(request)
+
+    def _parse(self, request: Dict) -> str:
+        try:
+            command = request["command"]
+            output = request["output"]
+        except KeyError as e:
+            raise ParseServiceError("Missing field {}".format(e))
+        return self.engine(command, output, request.get("network_os", "nxos"), request.get("device"))
+
+    def _parse_many(self, jobs: Iterable) -> Iterator[str]:
+        "Parse the jobs one after the other, failures are reported per job"
+        for job in jobs:
+            if isinstance(job, dict):
+                command, output = job.get("command"), job.get("output")
+                network_os, device = job.get("network_os", "nxos"), job.get("device")
+            else:
+                command, output, network_os = _job_fields(job)
+                device = None
+            head = '{"command": ' + json.dumps(command) + ', "network_os": ' + json.dumps(network_os) + ', '
+            try:
+                yield head + '"result": ' + self.engine(command, output, network_os, device) + '}'
+            except Exception as e:
+                yield head + '"error": ' + json.dumps(_error_message(e)) + '}'
+
+    def stats(self) -> Dict[str, Any]:
+        engine = self.engine
+        stats = {"uptime_s": time.time() - self.started, "requests": self.requests, "errors": self.errors,
+                 "network_os": sorted(engine.indexes), "devices": len(engine.device_os),
+                 "parser_cache": engine.cache.stats()}
+        if engine.result_cache is not None:
+            stats["result_cache"] = engine.result_cache.stats()
+        if self.preloaded:
+            stats["preload"] = {network_os: {"seconds": report.seconds, "built": len(report.built),
+                                             "failed": report.failed}
+                                for network_os, report in self.preloaded.items()}
+        if hasattr(engine.metrics, "summary"):
+            stats["phases"] = engine.metrics.summary()
+        return stats
+
+
+class _StreamHandler(socketserver.StreamRequestHandler):
+    "One ndjson request per line, responses are written in request order"
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            response = self.server.service.handle_line(line)
+            self.wfile.write(response.encode() + b"\n")
+            self.wfile.flush()
+
+
+class UnixParseServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str, service: ParseService):
+        if os.path.exists(path):
+            os.unlink(path)
+        self.service = service
+        super().__init__(path, _StreamHandler)
+        # only the owner may talk to the service
+        os.chmod(path, 0o600)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+class _HTTPHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path != "/stats":
+            return self._reply(404, '{"error": "Unknown path"}')
+        self._reply(200, self.server.service.handle({"op": "stats"}))
+
+    def do_POST(self):
+        op = self.path.lstrip("/")
+        if op not in ("parse", "parse_many"):
+            return self._reply(404, '{"error": "Unknown path"}')
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length < 0:
+                raise ValueError("negative Content-Length {}".format(length))
+        except ValueError as e:
+            # the body can't be skipped without a length, so the connection can't be reused
+            self.close_connection = True
+            return self._reply(400, '{"error": ' + json.dumps(_error_message(e)) + '}')
+        try:
+            request = json.loads(self.rfile.read(length))
+            if not isinstance(request, dict):
+                raise ValueError("request is not a json object")
+        except ValueError as e:
+            return self._reply(400, '{"error": ' + json.dumps(_error_message(e)) + '}')
+        request["op"] = op
+        self._reply(200, self.server.service.handle(request))
+
+    def _reply(self, status: int, body: str):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class HTTPParseServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], service: ParseService):
+        self.service = service
+        super().__init__(address, _HTTPHandler)
+
+
+class ParseClient:
+    """Thin client of the parse service, over the unix socket or http. Not thread safe, use one client per
+    thread."""
+
+    def __init__(self, socket_path: Optional[str] = DEFAULT_SOCKET, url: Optional[str] = None,
+                 timeout: Optional[float] = 60.0):
+        """
+
+        :param socket_path: unix socket of the service, ignored when url is given
+        :type socket_path: str
+        :param url: http address of the service, e.g. http://127.0.0.1:8765
+        :type url: str
+        :param timeout: seconds to wait for a response
+        :type timeout: float
+        """
+        self.socket_path = socket_path
+        self.url = url
+        self.timeout = timeout
+        self._socket: Optional[socket.socket] = None
+        self._reader = None
+        self._http: Optional[http.client.HTTPConnection] = None
+        self._next_id = 0
+
+    def parse(self, command: str, output: str, network_os: str = "nxos", device: Optional[str] = None) -> Any:
+        "Parse a command output in the service and return the parsed result"
+        return self._result(self.request({"op": "parse", "command": command, "output": output,
+                                          "network_os": network_os, "device": device}))
+
+    def parse_many(self, jobs: Iterable[Tuple[str, ...]]) -> List[ParseResult]:
+        """Parse (command, output) or (command, output, network_os) jobs in one request
+
+        :return: one ParseResult per job, result is the parsed result or error describes the failure
+        :rtype: list
+        """
+        response = self._result(self.request({"op": "parse_many", "jobs": [list(job) for job in jobs]}),
+                                "results")
+        return [ParseResult(index, item["command"], item["network_os"], item.get("result"), item.get("error"))
+                for index, item in enumerate(response)]
+
+    def stats(self) -> Dict[str, Any]:
+        return self._result(self.request({"op": "stats"}))
+
+    def request(self, request: Dict) -> Dict:
+        "Send one request and return the decoded response"
+        return self.pipeline([request])[0]
+
+    def pipeline(self, requests: Iterable[Dict]) -> List[Dict]:
+        """Send requests without waiting for the previous responses, the service answers them in order. The
+        requests are written by a thread while the responses are read, so neither side blocks on a full socket
+        buffer. Over http the requests are sent one after the other on a kept alive connection. On any error the
+        connection is closed, so a later call never reads the responses of an earlier one."""
+        requests = list(requests)
+        for request in requests:
+            if request.get("id") is None:
+                self._next_id += 1
+                request["id"] = self._next_id
+        if self.url:
+            return [self._http_request(request) for request in requests]
+        writer = None
+        try:
+            self._connect()
+            lines = [(json.dumps(request) + "\n").encode() for request in requests]
+            if len(lines) == 1:
+                # the service reads a whole request before it answers, one request can't fill both buffers
+                self._socket.sendall(lines[0])
+            else:
+                writer = threading.Thread(target=self._send, args=(self._socket, lines), name="parse-client-writer",
+                                          daemon=True)
+                writer.start()
+            responses = []
+            for _ in requests:
+                line = self._reader.readline()
+                if not line:
+                    raise ParseServiceError("Connection closed by the parse service")
+                responses.append(json.loads(line))
+        except BaseException:
+            self.close()
+            raise
+        finally:
+            if writer is not None:
+                writer.join()
+        return responses
+
+    def close(self):
+        if self._socket is not None:
+            try:
+                # wakes a writer thread blocked in sendall
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._reader.close()
+            self._socket.close()
+            self._socket = None
+            self._reader = None
+        if self._http is not None:
+            self._http.close()
+            self._http = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _connect(self):
+        if self._socket is None:
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.settimeout(self.timeout)
+            self._socket.connect(self.socket_path)
+            self._reader = self._socket.makefile("rb")
+
+    @staticmethod
+    def _send(sock: socket.socket, lines: List[bytes]):
+        "Writer thread of pipeline, a failure shows up to the reader as a closed connection or a timeout"
+        try:
+            for line in lines:
+                sock.sendall(line)
+        except OSError as e:
+            logger.debug("Sending pipelined requests failed: {}".format(e))
+
+    def _http_request(self, request: Dict) -> Dict:
+        if self._http is None:
+            address = self.url.split("://", 1)[-1].rstrip("/")
+            self._http = http.client.HTTPConnection(address, timeout=self.timeout)
+        op = request.get("op", "parse")
+        try:
+            if op == "stats":
+                self._http.request("GET", "/stats")
+            else:
+                self._http.request("POST", "/" + op, body=json.dumps(request),
+                                   headers={"Content-Type": "application/json"})
+            return json.loads(self._http.getresponse().read())
+        except BaseException:
+            # a half read response would otherwise be taken for the answer to the next request
+            self.close()
+            raise
+
+    @staticmethod
+    def _result(response: Dict, field: str = "result") -> Any:
+        if "error" in response:
+            raise ParseServiceError(response["error"])
+        return response[field]
+
+
+def serve(args):
+    result_cache = ResultCache(args.result_cache_mb * 1024 * 1024) if args.result_cache_mb else None
+    engine = ParserEngine(args.parser_dir, cache_dir=args.cache_dir, cache_size=None, result_cache=result_cache,
+                          serializer=args.serializer)
+    service = ParseService(engine, args.preload, args.preload_workers, args.preload_processes)
+    if args.watch:
+        engine.start_watching(args.watch)
+    servers = []
+    if args.http:
+        host, _, port = args.http.rpartition(":")
+        servers.append(HTTPParseServer((host or "127.0.0.1", int(port)), service))
+    if args.socket or not servers:
+        servers.append(UnixParseServer(args.socket or DEFAULT_SOCKET, service))
+    threads = [threading.Thread(target=server.serve_forever, daemon=True) for server in servers]
+    for thread in threads:
+        thread.start()
+    logger.info("Serving on {}".format(", ".join(str(server.server_address) for server in servers)))
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        engine.close()
+
+
+def parse(args):
+    with ParseClient(args.socket, args.url) as client:
+        output = pathlib.Path(args.output_file).read_text() if args.output_file else sys.stdin.read()
+        print(json.dumps(client.parse(args.command, output, args.network_os, args.device), indent=2))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="action", required=True)
+    server = sub.add_parser("serve", help="run the parse service")
+    server.add_argument("--parser-dir", default=r"./src/genie/libs/parser")
+    server.add_argument("--cache-dir")
+    server.add_argument("--preload", nargs="*", default=[], help="network os whose parsers are built at start up")
+    server.add_argument("--preload-workers", type=int, help="threads, or processes, building the parsers")
+    server.add_argument("--preload-processes", action="store_true",
+                        help="scan and compile the preloaded parsers in worker processes")
+    server.add_argument("--socket", help="unix socket path, the default when --http is not given")
+    server.add_argument("--http", help="serve http on host:port, e.g. 127.0.0.1:8765")
+    server.add_argument("--serializer", default="json")
+    server.add_argument("--result-cache-mb", type=int, default=0)
+    server.add_argument("--watch", type=float, help="poll the parser directories for changes every WATCH seconds")
+    client = sub.add_parser("parse", help="parse a command output in a running service")
+    client.add_argument("--socket", default=DEFAULT_SOCKET)
+    client.add_argument("--url", help="http address of the service instead of the unix socket")
+    client.add_argument("--command", required=True)
+    client.add_argument("--output-file", help="defaults to stdin")
+    client.add_argument("--network-os", default="nxos")
+    client.add_argument("--device")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    if args.action == "serve":
+        serve(args)
+    else:
+        parse(args)
+
+
+if __name__ == '__main__':
+    main()